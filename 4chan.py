@@ -4,16 +4,46 @@ import gui
 
 from snip import jfileutil as ju
 
-import json
 import os
+import multiprocessing
+import blobstore
+import render
 import tqdm
 import requests
 import snip.net
+import threading
+import time
 import timeout_decorator
 
 from json.decoder import JSONDecodeError
 from os import stat
-from snip.flow import slowfunc
+from engine import DownloadEngine
+from engine import setApiRate
+from archive import ThreadArchive
+from archive import postText
+from backends import DEFAULT_SERVER
+from backends import loadBackends
+from checkpoint import CheckpointStore
+from fileindex import FileIndex
+from fileindex import SAVED_FILE_PATTERN
+from httpcache import ValidatorCache
+from metrics import metrics
+from models import Board
+from models import Post
+from models import Thread
+from paths import getDestImagePath
+from paths import getDestImagePathLegacy
+from paths import getDestImagePathLegacy2
+from paths import getDestImagePathLegacy3
+from paths import getMessageLogPath
+from pipeline import DownloadPipeline
+from priority import LOWEST_PRIORITY
+from priority import PrioritySlots
+from priority import mediaPriority
+from priority import threadPriority
+from queuestore import QueueStore
+from rules import loadRules
+from snip import loom
 from urllib.error import HTTPError
 from urllib.error import URLError
 from urllib.request import urlretrieve
@@ -21,15 +51,44 @@ from urllib.request import urlretrieve
 from snip.stream import TriadLogger
 logger = TriadLogger(__name__)
 
-# Making this extensible to boards like 8chan:
-# 1. Make a API mappings file
-# 2. Make classes for: Threads, Posts, Chans
-# 3. Refactor production code to create objects based on mappings
-# 4. Refactor consumption code to read object attributes
-# 5. Extend mappings file
+# Site specific urls, field names and rate limits come from the API mappings
+# in backends.py (the Backends jobj file). Boards are matched to a site through
+# the server keys of the Boards file.
 
 # Utility functions and classes
 
+downloader = DownloadEngine()
+
+DEFAULT_BOARD_WORKERS = 4
+DEFAULT_THREAD_WORKERS = 2  # Per board
+DEFAULT_TOTAL_THREAD_WORKERS = 8
+
+# Caps the number of threads being processed at once, across all boards.
+# Threads most at risk of 404ing get a slot first.
+threadSlots = PrioritySlots(DEFAULT_TOTAL_THREAD_WORKERS)
+progressLock = threading.Lock()  # Guards the total of a progress bar shared by boards
+
+# Watch mode polling bounds, in seconds
+WATCH_MIN_INTERVAL = 30
+WATCH_MAX_INTERVAL = 30 * 60
+WATCH_BACKOFF = 1.5
+WATCH_CATALOG_INTERVAL = 5 * 60  # With --auto, how often catalogs are checked for new matches
+
+validatorCache = ValidatorCache()
+checkpoints = CheckpointStore()
+fileIndex = FileIndex()
+threadArchive = ThreadArchive()
+queueStore = QueueStore()
+
+prometheusPath = None  # Where to export metrics for Prometheus, if anywhere
+metricsLock = threading.Lock()  # One metrics write at a time, so saves from different threads don't interleave
+
+backends = {}  # server -> Backend
+boardBackends = {}  # board -> Backend
+
+# Set once migrateLegacyPaths has run; until then the download path checks legacy names itself
+legacyMigrated = ju.json_load("legacyMigration", default={}).get("done", False)
+
 
 def exec_with_timeout(secs, func, *args, **kwargs):
     """Wrap a function in a timeout. 
@@ -66,139 +125,241 @@ def loadBoards():
         logger.info("Please edit the template file in the jobj folder!")
         return example
 
-# Parsing
-
-
-def trimObj(obj, interest):
-    """Remove a set of keys from a dictionary
-    
-    Args:
-        obj (Dict): Description
-        interest (List): List of keys to remove
-    
-    Returns:
-        Dict: Filtered version of obj
+def getBackend(board):
     """
-    pops = []
-    for key in obj.keys():
-        if key not in interest:
-            pops.append(key)
-    for key in pops:
-        obj.pop(key)
-    return obj
-
-
-def trimThread(thread):
-    """Removes unneeded metadata from thread JSON
-    
     Args:
-        thread (dict): Thread json object
+        board (str): Board acronym
     
     Returns:
-        Dict: Trimmed thread json
+        Backend: The backend of the server the board is listed under; 4chan if it isn't listed
     """
-    interest = [
-        "no",
-        "name",
-        "sub",
-        "com",
-        "tim",
-        "time",
-        "archived",
-        "semantic_url",
-        "tag"
-    ]
-    return trimObj(thread, interest)
+    if not backends:
+        backends.update(loadBackends())
+    return boardBackends.get(board) or backends[DEFAULT_SERVER]
 
 
-def formatPost(post):
-    """Converts a post json to an HTML fragment
-    
-    Args:
-        post (Dict): Post json object
+def loadBoardBackends():
+    """Match every configured board to its server's backend, and apply each backend's limits.
     
     Returns:
-        str: HTML representation of post
+        List: Board acronyms, in configured order
     """
-    subfields = ["sub", "name", "now", "no"]
-    subline = " ".join([str(post.get(field))
-                        for field in subfields if post.get(field) is not None])
-    return "\
-<div class='post'>\
-<span class='subline' id='p{no}'>>{subline} >>{no}</span>\n \
-<span class='file'>File: {file}</span>\n\
-{com}</div>".format(
-        subline=subline,
-        no=post.get("no"),
-        file=(post.get("filename") + post.get("ext")
-              if post.get("filename") else "None"),
-        com=(("\n<p class='comment'>" + post.get("com") + "</p>") if post.get("com") else "")
-    )
+    if not backends:
+        backends.update(loadBackends())
+    boards = []
+    for (server, serverBoards) in loadBoards().items():
+        backend = backends.get(server)
+        if backend is None:
+            logger.error("No API mappings for server '{}', skipping its boards".format(server))
+            continue
+        backend.register(downloader)
+        for board in serverBoards:
+            if boardBackends.get(board, backend) is not backend:
+                logger.warning("/{}/ is listed under more than one server, using {}".format(board, server))
+            boardBackends[board] = backend
+            boards.append(board)
+    return boards
+
+# Parsing
 
 
 def getThreads(board):
-    """Generates trimmed versions of all threads in a board.
+    """Generates all threads in a board's catalog.
     
     Args:
         board (str): Board acronym
     
     Yields:
-        Dict: Thread json object
+        Thread: Catalog thread, with only the OP
     """
+    backend = getBackend(board)
+    url = backend.url("catalog", board=board)
     try:
-        catalog = requests.get("https://a.4cdn.org/{}/{}.json".format(board, "catalog"))
-        if not catalog.ok:
-            catalog.raise_for_status()
-        catalog = catalog.json()
+        with metrics.timed("catalog_fetch", board=board):
+            catalog = validatorCache.fetchJson(url)
     except JSONDecodeError:
-        logger.info(catalog)
+        logger.info(url)
         raise
-    for page in catalog:
-        for thread in page.get("threads"):
-            yield trimThread(thread)
+    threads = Board.fromCatalog(board, catalog, backend.fields).threads
+    metrics.count("threads", len(threads), stage="catalog", board=board)
+    yield from threads
 
 # Saving
 
 
-def saveThreads(board, queue):
-    from simplejson.errors import JSONDecodeError
+def getBoardActivity(board):
+    """Get the last modification time of every live thread on a board, in one request.
+    
+    Args:
+        board (str): Board acronym
+    
+    Returns:
+        Dict: Thread number -> (last_modified, pages below the thread's page),
+        or None if the site has no thread list
+    """
+    url = getBackend(board).url("threads", board=board)
+    if not url:
+        return None
+    threadList = validatorCache.fetchJson(url)
+    return {
+        thread.get("no"): (thread.get("last_modified"), len(threadList) - 1 - pageIndex)
+        for (pageIndex, page) in enumerate(threadList)
+        for thread in page.get("threads")
+    }
+
+
+def getBoardArchive(board):
+    """
+    Args:
+        board (str): Board acronym
+    
+    Returns:
+        Set: Numbers of archived threads; empty if the board has no archive,
+            None if the archive couldn't be fetched
+    """
+    url = getBackend(board).url("archive", board=board)
+    if not url:
+        return set()
+    try:
+        return set(validatorCache.fetchJson(url))
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return set()
+        logger.error("Can't get archive for /{}/".format(board), exc_info=True)
+    except (requests.exceptions.RequestException, ValueError):
+        logger.error("Can't get archive for /{}/".format(board), exc_info=True)
+    return None
+
+
+def scheduleChangedThreads(board, queue):
+    """Work out which queued threads need fetching, using the board's thread list and archive.
+    Live threads are only due if their last_modified moved since they were last saved.
+    Archived threads are due for one final save. Threads that are neither are pruned now,
+    unless the archive couldn't be fetched, in which case they are fetched to find out.
+    Due threads are ordered by their risk of 404ing, most at risk first.
+    
+    Args:
+        board (str): Board acronym
+        queue (List): List of thread json objects
+    
+    Returns:
+        List: Tuples of (thread number, last_modified or None, priority) to fetch
+    """
+    try:
+        live = getBoardActivity(board)
+    except (requests.exceptions.RequestException, ValueError):
+        logger.error("Can't get thread list for /{}/, fetching every thread".format(board), exc_info=True)
+        live = None
+    if live is None:
+        return sorted(
+            [(thread.get("no"), None, threadPriority(thread)) for thread in queue],
+            key=lambda job: job[2]
+        )
+
+    due = []
+    missing = [thread.get("no") for thread in queue if thread.get("no") not in live]
+    archived = getBoardArchive(board) if missing else set()
+    for thread in queue:
+        threadno = thread.get("no")
+        if threadno in live:
+            (lastModified, pagesLeft) = live[threadno]
+            if checkpoints.get(board, threadno, "modified") != lastModified:
+                due.append((threadno, lastModified, threadPriority(thread, lastModified, pagesLeft),))
+        elif archived is None:
+            # Can't tell archived threads from dead ones, so fetch and let the 404s speak
+            due.append((threadno, None, threadPriority(thread),))
+        elif threadno in archived:
+            due.append((threadno, None, threadPriority(thread, archived=True),))
+
+    dead = [threadno for threadno in missing if archived is not None and threadno not in archived]
+    if dead:
+        logger.info("/{}/: {} threads 404".format(board, len(dead)))
+        handleThreads404(board, dead)
+    return sorted(due, key=lambda job: job[2])
+
+
+def saveThreads(board, queue, workers=DEFAULT_THREAD_WORKERS, progress=None):
     """Process saving of threads in a board. Saves messages and html.
+    Only threads that changed since they were last saved are fetched.
+    Up to `workers` threads of the board are processed at once.
     
     Args:
         board (str): Board acronym
         queue (List): List of thread json objects
+        workers (int, optional): Max threads of this board to process at once
+        progress (tqdm, optional): Shared progress bar to add this board's threads to
     """
-    # widgets = [
-    #     "{:5.5}".format(board),
-    #     ' ', progressbar.Percentage(),
-    #     ' ', progressbar.Bar(),
-    #     ' ', progressbar.SimpleProgress(),
-    #     ' ', progressbar.Timer(),
-    #     ' ', progressbar.AdaptiveETA(),
-    # ]
-    # for thread in progressbar.progressbar(queue, widgets=widgets, redirect_stdout=False):
-    # for thread in progressbar.progressbar(queue, widgets=widgets, redirect_stdout=True):
-    # for (enum, thread) in enumerate(queue):
-    #     logger.info("{:5.5} {}/{}".format(board, enum, len(queue)))
-    progress = tqdm.tqdm(queue, unit="thread", desc=board)
-    for thread in progress:
+    due = scheduleChangedThreads(board, queue)
+    if progress is None:
+        boardProgress = tqdm.tqdm(total=len(due), unit="thread", desc=board)
+    else:
+        boardProgress = progress
+        with progressLock:
+            progress.total += len(due)
+            progress.refresh()
+    with loom.Spool(workers) as spool:
+        for (threadno, lastModified, priority) in due:
+            spool.enqueue(
+                name=str(threadno), target=saveThread,
+                args=(board, threadno, boardProgress, lastModified, priority,))
+        spool.finish()
+    if progress is None:
+        boardProgress.close()
+    saveState()
+
+
+def saveThread(board, threadno, progress=None, lastModified=None, priority=LOWEST_PRIORITY):
+    from simplejson.errors import JSONDecodeError
+    """Fetch a single thread and save its messages and images.
+    Threads that haven't changed since they were last fully saved are skipped.
+    Archived threads are dropped from the queue once fully saved.
+    
+    Args:
+        board (str): Board acronym
+        threadno (int): Thread numerical id
+        progress (tqdm, optional): Board progress bar, advanced when done
+        lastModified (int, optional): The thread's last_modified, recorded once it is fully saved
+        priority (Tuple, optional): Place in line for a thread slot, across all boards; smallest first
 
-        threadno = thread.get("no")
-        threadurl = "https://a.4cdn.org/{}/thread/{}.json".format(board, threadno)
+    Returns:
+        Thread: The thread, or None if it was unchanged, gone or failed
+    """
+    backend = getBackend(board)
+    threadurl = backend.url("thread", board=board, no=threadno)
+    with threadSlots.slot(priority):
         try:
             # Get thread data
-            req = requests.get(threadurl)
-            req.raise_for_status()
-            threadJson = req.json()
-            sem = threadJson.get("posts")[0].get("semantic_url")
+            with metrics.timed("thread_fetch", board=board):
+                req = validatorCache.fetch(threadurl)
+                if req.status_code == 304:
+                    metrics.count("threads", stage="thread", result="unchanged")
+                    if lastModified:
+                        checkpoints.set(board, threadno, "modified", lastModified)
+                    return
+                req.raise_for_status()
+                threadJson = req.json()
+            thread = Thread.fromJson(board, threadJson.get("posts"), backend.fields)
 
             # Run thread operations
-            saveMessageLog(threadno, sem, threadJson, board)
-            saveImageLog(threadno, sem, threadJson, board)
-
-        except requests.exceptions.HTTPError:
-            progress.write("Thread {} 404")
-            handleThread404(board, threadno)
+            saveMessageLog(thread, threadJson)
+            failures = saveImageLog(thread)
+            metrics.count("threads", stage="thread", result="incomplete" if failures else "saved")
+            if not failures:
+                validatorCache.commit(threadurl, req)
+                if lastModified:
+                    checkpoints.set(board, threadno, "modified", lastModified)
+                if thread.archived:
+                    logger.info("Thread {} archived".format(threadno))
+                    handleThread404(board, threadno)
+            return thread
+
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                logger.info("Thread {} 404".format(threadno))
+                handleThread404(board, threadno)
+            else:
+                # Likely temporary (5xx, rate limits); keep the thread and try again later
+                logger.error("Error with thread [{}] {}".format(threadno, threadurl), exc_info=True)
 
         except OSError:
             logger.error("Error with thread [{}] {}".format(threadno, threadurl), exc_info=True)
@@ -209,252 +370,398 @@ def saveThreads(board, queue):
         except ConnectionError:
             logger.error("Error with thread [{}] {}".format(threadno, threadurl), exc_info=True)
 
+        finally:
+            if progress:
+                progress.update(1)
+
 
-def saveImageLog(threadno, sem, threadJson, board, verbose=False):
+def saveImageLog(thread, verbose=False):
     """Saves all images in a thread, skipping up-to-date images.
+    Only posts after the thread's "media" checkpoint are examined.
+    Files already in the blob store under the post's md5 are linked instead of downloaded.
     
     Args:
-        threadJson 
-        board (str): Board acronym
-        sem (str): Thread semantic url (text id)
+        thread (Thread): Full thread
         verbose (bool, optional): Print verbose output
+
+    Returns:
+        List: Downloads that failed
     """
+    (board, threadno, sem) = (thread.board, thread.no, thread.semantic_url)
     skips = 0
-    threadPosts = threadJson.get("posts")
+    lastSeen = checkpoints.get(board, threadno, "media")
+    threadPosts = [post for post in thread.posts if post.no > lastSeen]
     realPosts = []
+    skipStart = time.monotonic()
     for post in threadPosts:
-        if post.get("ext"):
+        if post.file:
 
             (dstdir, dstfile, dstpath) = getDestImagePath(board, sem, post, threadno)
 
-            # Begin legacy code block
+            if fileIndex.has(board, post.no, dstpath, post.file.fsize):
+                metrics.count("files", stage="skip_check", result="indexed")
+                skips += 1
+                continue
 
-            (__, __, legacyDestPath) = getDestImagePathLegacy(board, sem, post)
-            if os.path.exists(legacyDestPath):
-                if not os.path.exists(dstpath):
-                    snip.filesystem.moveFileToFile(legacyDestPath, dstpath)
-                else:
-                    os.unlink(legacyDestPath)
-
-            (__, __, legacyDestPath) = getDestImagePathLegacy2(board, sem, post)
-            if os.path.exists(legacyDestPath):
-                if not os.path.exists(dstpath):
-                    snip.filesystem.moveFileToFile(legacyDestPath, dstpath)
-                else:
-                    os.unlink(legacyDestPath)
+            # Begin legacy code block
 
-            (__, __, legacyDestPath) = getDestImagePathLegacy3(board, sem, post, threadno)
-            if os.path.exists(legacyDestPath):
-                if not os.path.exists(dstpath):
-                    snip.filesystem.moveFileToFile(legacyDestPath, dstpath)
-                else:
-                    os.unlink(legacyDestPath)
+            if not legacyMigrated:
+                (__, __, legacyDestPath) = getDestImagePathLegacy(board, sem, post)
+                if os.path.exists(legacyDestPath):
+                    if not os.path.exists(dstpath):
+                        snip.filesystem.moveFileToFile(legacyDestPath, dstpath)
+                    else:
+                        os.unlink(legacyDestPath)
+
+                (__, __, legacyDestPath) = getDestImagePathLegacy2(board, sem, post)
+                if os.path.exists(legacyDestPath):
+                    if not os.path.exists(dstpath):
+                        snip.filesystem.moveFileToFile(legacyDestPath, dstpath)
+                    else:
+                        os.unlink(legacyDestPath)
+
+                (__, __, legacyDestPath) = getDestImagePathLegacy3(board, sem, post, threadno)
+                if os.path.exists(legacyDestPath):
+                    if not os.path.exists(dstpath):
+                        snip.filesystem.moveFileToFile(legacyDestPath, dstpath)
+                    else:
+                        os.unlink(legacyDestPath)
 
             # End legacy code block
 
             if (os.path.exists(dstpath)):
-                if post.get("fsize") == stat(dstpath).st_size:
+                if post.file.fsize == stat(dstpath).st_size:
+                    # Not adopted into the blob store: only the size was checked, not the md5
+                    fileIndex.add(board, post, dstpath)
+                    metrics.count("files", stage="skip_check", result="on_disk")
                     skips += 1
                     continue
             realPosts.append(post)
+    metrics.observe("latency_seconds", time.monotonic() - skipStart, stage="skip_check")
 
-    totalSize = sum([post.get("fsize") for post in realPosts if post.get("fsize")])
-    post_generator = tqdm.tqdm(realPosts, desc=sem, total=totalSize, unit='B', unit_scale=True)
-    for post in post_generator:
-        fsize = post.get("fsize")
+    jobs = []
+    jobPosts = {}
+    # Smallest files first, so a thread that dies mid-download leaves as much saved as possible
+    for post in sorted(realPosts, key=mediaPriority):
         (dstdir, dstfile, dstpath) = getDestImagePath(board, sem, post, threadno)
-
-        src = f"https://i.4cdn.org/{board}/{post.get('tim')}{post.get('ext')}"
-        
         os.makedirs(dstdir, exist_ok=True)
-        try:
-            success = slowfunc(0.2, snip.net.saveStreamAs, (snip.net.getStream(src), dstpath,))
-            if not success:
-                post_generator.total -= fsize
-        except requests.exceptions.HTTPError:
-            logger.error("Error", exc_info=True)
-        except OSError:
-            logger.error("Error", exc_info=True)
-        finally:
-            post_generator.update(fsize)
+        if post.file.md5 and blobstore.linkFromStore(post.file.md5, post.file.ext, dstpath):
+            fileIndex.add(board, post, dstpath)
+            metrics.count("files", stage="skip_check", result="linked")
+            skips += 1
+            continue
+        src = getBackend(board).url("media", board=board, tim=post.file.tim, ext=post.file.ext)
+        jobs.append((src, dstpath, post.file.fsize, post.file.md5,))
+        jobPosts[dstpath] = post
+    failures = downloader.download(jobs, desc=sem)
+
+    failedPaths = set(dstpath for (src, dstpath, fsize, md5) in failures)
+    for (dstpath, post) in jobPosts.items():
+        if dstpath not in failedPaths:
+            fileIndex.add(board, post, dstpath)
+            # The engine verified the download against this md5
+            if post.file.md5:
+                blobstore.addToStore(dstpath, post.file.md5, post.file.ext)
+
+    # Advance up to, but not past, the first failed download
+    if threadPosts:
+        if failures:
+            firstFailure = min(jobPosts[dstpath].no for dstpath in failedPaths)
+            done = [post.no for post in threadPosts if post.no < firstFailure]
+            if done:
+                checkpoints.set(board, threadno, "media", max(done))
+        else:
+            checkpoints.set(board, threadno, "media", threadPosts[-1].no)
 
     if (skips > 0) and verbose:
         logger.info("Skipped {:>3} existing images. ".format(skips))
+    return failures
 
 
-def saveMessageLog(threadno, sem, threadJson, board):
-    """Save text messages to html
+def saveMessageLog(thread, threadJson):
+    """Save text messages to html.
+    Posts after the thread's "log" checkpoint are appended to the existing log.
     
     Args:
-        threadno (int): Thread numerical id
-        sem (str): Thread semantic url (text id)
-        threadJson
-        board (str): Board acronym
+        thread (Thread): Full thread
+        threadJson (Dict): The thread's raw json; new posts are saved to the thread archive as-is
+    """
+    (board, threadno, sem) = (thread.board, thread.no, thread.semantic_url)
+    (__, filePath) = getMessageLogPath(board, sem, threadno)
+
+    lastSeen = checkpoints.get(board, threadno, "log")
+    if lastSeen and not os.path.exists(filePath + ".htm"):
+        lastSeen = 0
+    newPosts = [post for post in thread.posts if post.no > lastSeen]
+    if not newPosts:
+        return
+
+    # The OP is always rewritten, since its reply counts and flags change
+    with metrics.timed("archive_save"):
+        threadArchive.savePosts(board, threadno, sem, [
+            raw
+            for (post, raw) in zip(thread.posts, threadJson.get("posts"))
+            if post.no > lastSeen or post is thread.op
+        ])
+
+    with metrics.timed("render"):
+        render.writeLog(thread, newPosts, append=bool(lastSeen))
+    metrics.count("posts", len(newPosts), stage="render")
+    checkpoints.set(board, threadno, "log", newPosts[-1].no)
+
+
+def regenerateLogs(workers=None):
+    """Rewrite every html log from the thread archive, i.e. after a template change.
     
-    Returns:
-        TYPE: Description
+    Args:
+        workers (int, optional): Number of processes; one per cpu by default
     """
-    msgBase = "./text/{}/".format(board)
-    filePath = "{}{s}_{n}".format(msgBase, s=sem, n=threadno)
+    jobs = [
+        (threadArchive.dbpath, board, threadno, getBackend(board).fields)
+        for (board, threadno) in threadArchive.threads()
+    ]
+    for result in tqdm.tqdm(render.renderAll(jobs, workers), total=len(jobs), unit="thread"):
+        metrics.count("threads", stage="render", result="ok" if result else "failed")
+        if result:
+            (board, threadno, lastno) = result
+            checkpoints.set(board, threadno, "log", lastno)
+    checkpoints.save()
+    writeMetrics()
 
-    try:
-        lastPostTime = threadJson.get("posts")[-1].get("time")
-        fileUpdateTime = os.path.getmtime(filePath)
-        if fileUpdateTime > lastPostTime:
-            return
-    except FileNotFoundError:
-        pass
 
-    os.makedirs(msgBase, exist_ok=True)
-    json.dump(threadJson, open(filePath + ".json", "w", encoding="utf-8"))
+def searchArchive(query, limit=50):
+    """Print archived posts matching a full text query, with where their files are saved.
+    
+    Args:
+        query (str): Words, or an SQLite FTS5 query
+        limit (int, optional): Max results
+    """
+    try:
+        results = threadArchive.search(query, limit)
+    except ValueError as e:
+        print(e)
+        return
+    for (board, threadno, sem, snippet, postJson) in results:
+        post = Post.fromJson(postJson, getBackend(board).fields)
+        print("/{}/{} >>{}: {}".format(board, threadno, post.no, snippet))
+        if post.file:
+            print("    {}".format(getDestImagePath(board, sem, post, threadno)[2]))
 
-    os.makedirs(msgBase, exist_ok=True)
-    with open(filePath + ".htm", "w", encoding="utf-8") as textfile:
-        textfile.write('<link rel="stylesheet" type="text/css" href="4chan.css" />\n')
-        textfile.write('<link rel="stylesheet" type="text/css" href="../4chan.css" />\n')
-        # logger.info("------> {}".format(filePath))
-        for post in threadJson.get("posts"):
-            textfile.write(formatPost(post))
+# Migration
 
 
-def getDestImagePath(board, sem, post, threadno):
-    """Generates paths for saving images
+def migrateThreadLegacyPaths(board, threadno, dryrun, report, handled, reportLock):
+    """Rename one thread's files from the legacy layouts to the current one.
 
-    Returns:
-        Tuple (directory, file, path)
+    Args:
+        board (str): Board acronym
+        threadno (int): Thread numerical id
+        dryrun (bool): Only count what would be done
+        report (Dict): Counters, updated in place
+        handled (Set): Normalized paths of legacy files moved or removed (or that would be), updated in place
+        reportLock (threading.Lock): Guards `report` and `handled`
     """
-    dstdir = "./saved/{}/{}/".format(board, sem)
-    dstfile = snip.filesystem.easySlug("{}-{}-{}{}".format(
-        threadno,
-        post.get("no"), 
-        post.get("filename"), 
-        post.get("ext")
-    ))
-    dstpath = os.path.join(dstdir, dstfile)
-    return (dstdir, dstfile, dstpath)
-
+    counts = {"moved": 0, "duplicates": 0, "threads": 1}
+    paths = []
+    try:
+        threadJson = threadArchive.loadThread(board, threadno)
+        thread = Thread.fromJson(board, threadJson.get("posts"), getBackend(board).fields)
+        sem = thread.semantic_url
+        dstdir = "./saved/{}/{}/".format(board, sem)
+        present = set(os.listdir(dstdir)) if os.path.isdir(dstdir) else set()
+
+        for post in thread.posts:
+            if not post.file:
+                continue
+            (__, dstfile, dstpath) = getDestImagePath(board, sem, post, threadno)
+            for (__, legacyFile, legacyDestPath) in [
+                getDestImagePathLegacy(board, sem, post),
+                getDestImagePathLegacy2(board, sem, post),
+                getDestImagePathLegacy3(board, sem, post, threadno)
+            ]:
+                if legacyFile == dstfile or legacyFile not in present:
+                    continue
+                present.discard(legacyFile)
+                paths.append(os.path.normpath(legacyDestPath))
+                if dstfile not in present:
+                    counts["moved"] += 1
+                    present.add(dstfile)
+                    if not dryrun:
+                        snip.filesystem.moveFileToFile(legacyDestPath, dstpath)
+                else:
+                    counts["duplicates"] += 1
+                    if not dryrun:
+                        os.unlink(legacyDestPath)
+    except (OSError, IndexError, TypeError):
+        logger.error("Error migrating /{}/{}".format(board, threadno), exc_info=True)
+        counts = {"errors": 1}
 
-def getDestImagePathLegacy3(board, sem, post, threadno):
-    """Generates paths for saving images
+    with reportLock:
+        for (key, value) in counts.items():
+            report[key] = report.get(key, 0) + value
+        handled.update(paths)
 
-    Returns:
-        Tuple (directory, file, path)
-    """
-    dstdir = "./saved/{}/{}/".format(board, sem)
-    if post.get("tim") != post.get("filename"):
-        dstfile = snip.filesystem.easySlug("{}-{}-{}{}".format(
-            threadno,
-            post.get("tim"), 
-            post.get("filename"), 
-            post.get("ext")
-        ))
-    else:
-        dstfile = snip.filesystem.easySlug("{}{}".format(
-            post.get("tim"), 
-            post.get("ext")
-        ))
-    dstpath = os.path.join(dstdir, dstfile)
-    return (dstdir, dstfile, dstpath)
 
+def migrateLegacyPaths(dryrun=False, workers=DEFAULT_BOARD_WORKERS):
+    """Rename every saved file from the legacy naming schemes to getDestImagePath's, once.
+    Legacy names depend on post data, so only threads in the thread archive can be migrated.
+    Once a run ends with no errors and no unrecognized files left, the download path
+    stops checking for legacy names.
 
-def getDestImagePathLegacy(board, sem, post):
-    """Generates paths for saving images
+    Args:
+        dryrun (bool, optional): Report what would be done without touching anything
+        workers (int, optional): Number of threads to migrate at once
 
     Returns:
-        Tuple (directory, file, path)
+        Dict: Counts of threads, moved files, removed duplicates and errors
     """
-    dstdir = "./saved/{}/{}/".format(board, sem)
-    dstfile = "{}{}".format(post.get("tim"), post.get("ext"))
-    dstpath = os.path.join(dstdir, dstfile)
-    # logger.info(dstdir, dstfile, dstpath)
-    return (dstdir, dstfile, dstpath)
-
-
-def getDestImagePathLegacy2(board, sem, post):
-    """Generates paths for saving images
+    global legacyMigrated
+    report = {}
+    handled = set()
+    reportLock = threading.Lock()
+    with loom.Spool(workers) as spool:
+        for (board, threadno) in threadArchive.threads():
+            spool.enqueue(
+                name=str(threadno), target=migrateThreadLegacyPaths,
+                args=(board, threadno, dryrun, report, handled, reportLock,))
+        spool.finish()
+
+    # Anything left that doesn't look like a current name was missed.
+    # In a dry run, the files that would have been moved or removed don't count.
+    report["unrecognized"] = sum(
+        1
+        for board in (os.listdir("./saved") if os.path.isdir("./saved") else [])
+        if not board.startswith(".") and os.path.isdir(os.path.join("./saved", board))
+        for semdir in os.scandir(os.path.join("./saved", board))
+        if semdir.is_dir()
+        for entry in os.scandir(semdir.path)
+        if not SAVED_FILE_PATTERN.match(entry.name) and os.path.normpath(entry.path) not in handled
+    )
 
-    Returns:
-        Tuple (directory, file, path)
-    """
-    dstdir = "./saved/{}/{}/".format(board, sem)
-    if post.get("tim") != post.get("filename"):
-        dstfile = snip.filesystem.easySlug("{}-{}{}".format(
-            post.get("tim"), 
-            post.get("filename"), 
-            post.get("ext")
-        ))
-    else:
-        dstfile = snip.filesystem.easySlug("{}{}".format(
-            post.get("tim"), 
-            post.get("ext")
-        ))
-    dstpath = os.path.join(dstdir, dstfile)
-    return (dstdir, dstfile, dstpath)
+    logger.info("{}Migrated {} threads: {} files moved, {} duplicates removed, {} errors, {} unrecognized files left".format(
+        "[Dry run] " if dryrun else "",
+        report.get("threads", 0), report.get("moved", 0), report.get("duplicates", 0),
+        report.get("errors", 0), report.get("unrecognized")
+    ))
+    if not dryrun:
+        # Files the migration failed on or never saw still need the download path's legacy checks
+        done = not report.get("errors") and not report.get("unrecognized")
+        if not done:
+            logger.info("Legacy names are still checked on download until a migration leaves nothing behind")
+        ju.json_save({"done": done, "report": report}, "legacyMigration")
+        legacyMigrated = done
+    return report
 
 # Main logic
 
 
-def selectImages(board, preSelectedThreads, saveCallback):
-    """Prompt user to select threads to queue
+def getArgs():
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-w", "--workers", type=int, default=None,
+                    help="Number of concurrent media downloads, across all sites. Default is {}".format(
+                        downloader.workers))
+    ap.add_argument("--rate", type=float, default=None,
+                    help="Max media requests per second per site, overriding the API mappings")
+    ap.add_argument("--api-rate", type=float, default=None,
+                    help="Max API requests per second per site, overriding the API mappings")
+    ap.add_argument("--boards", type=int, default=DEFAULT_BOARD_WORKERS,
+                    help="Number of boards to download at once. Default is {}".format(DEFAULT_BOARD_WORKERS))
+    ap.add_argument("--threads", type=int, default=DEFAULT_THREAD_WORKERS,
+                    help="Number of threads per board to download at once. Default is {}".format(DEFAULT_THREAD_WORKERS))
+    ap.add_argument("--total-threads", type=int, default=DEFAULT_TOTAL_THREAD_WORKERS,
+                    help="Number of threads to download at once across all boards. Default is {}".format(
+                        DEFAULT_TOTAL_THREAD_WORKERS))
+    ap.add_argument("--reindex", action="store_true",
+                    help="Rebuild the saved file index from disk and exit. "
+                    "Use after moving or deleting files in the saved folder")
+    ap.add_argument("--migrate", action="store_true",
+                    help="Rename saved files from legacy naming schemes in bulk and exit. "
+                    "Run --import-json first if you have json files from older versions")
+    ap.add_argument("--dry-run", action="store_true",
+                    help="With --migrate, only report what would be renamed")
+    ap.add_argument("--import-json", action="store_true",
+                    help="Import thread json files saved by older versions into the thread archive and exit")
+    ap.add_argument("--search", default=None, metavar="QUERY",
+                    help="Search archived post text and exit. Takes SQLite full text syntax, i.e. 'sub:ygyl OR cat*'")
+    ap.add_argument("--render", action="store_true",
+                    help="Regenerate every html log from the saved json and exit")
+    ap.add_argument("--watch", action="store_true",
+                    help="Don't show the selector; keep polling queued threads on an adaptive schedule")
+    ap.add_argument("--prometheus", default=None, metavar="PATH",
+                    help="Also write run metrics to this file in the Prometheus text format, "
+                    "i.e. for node_exporter's textfile collector. The json summary is always saved as runMetrics")
+    ap.add_argument("--auto", action="store_true",
+                    help="Don't show the selector; queue threads matching the rules in the Rules file. "
+                    "With --watch, catalogs are rechecked every {} seconds".format(WATCH_CATALOG_INTERVAL))
+    return ap.parse_args()
+
+
+def selectThreads(boards, onSave=None):
+    """Prompt user to select threads to queue, for every board in one window.
+    Catalogs load in the background while the window is open.
     
     Args:
-        board (str): Board acronym
-        preSelectedThreads (list): List of thread numbers that were previously selected
-        saveCallback (function): Function to save progress to file
+        boards (List): Board acronyms
+        onSave (function, optional): Called with the board after each saved selection
     
     Raises:
         KeyboardInterrupt: User canceled process from window
     """
-    preSelectionSet = set([thread.get("no") for thread in preSelectedThreads])
-    threads = list(getThreads(board))
-
-    # Find 404'd threads
-    liveThreadNos = set([thread.get("no") for thread in threads])
-    for thread in preSelectedThreads:
-        if thread.get("no") not in liveThreadNos:
-            logger.info("404: {}".format(thread.get("semantic_url")))
-            handleThread404(board, thread.get("no"))
-
-    # Window
     headers = [
-        ("no", "ID",),
         ("name", "Author",),
         ("sub", "Subject",),
         ("com", "Comment",),
         # ("time", "Time",),
         ("semantic_url", "URL",),
     ]
+    catalogs = {}  # board -> {thread number: Thread}
 
-    tablerows = [
-        {
-            'values':
-            [
-                str(thread.get(h[0])) for h in headers
-            ]
-        }
-        for thread in sorted(threads, key=lambda t: -t.get("no"))
-    ]
-
-    def subSaveCallback(selectionIdxs):
-        """Summary
+    def loadCatalog(board):
+        """Fetch a board's catalog. Runs off the GUI thread.
+        Queued threads missing from the catalog are left queued: they may only be archived,
+        which the download decides from the thread list, the archive and real 404s.
         
         Args:
-            selectionIdxs (TYPE): Description
+            board (str): Board acronym
+        
+        Returns:
+            Tuple: (rows, selected thread numbers)
         """
-        selection = [
-            thread
+        threads = sorted(getThreads(board), key=lambda t: -t.no)
+        catalogs[board] = {thread.no: thread for thread in threads}
+
+        rows = [
+            (thread.no, [str(thread.no)] + [postText(getattr(thread, h[0])) or "" for h in headers])
             for thread in threads
-            if thread.get("no")
-            in selectionIdxs
         ]
-        saveCallback(selection)
+        return (rows, set(thread.get("no") for thread in queueStore.get(board)))
+
+    def saveCallback(board, selectionNos):
+        """
+        Args:
+            board (str): Board acronym
+            selectionNos (Set): Selected thread numbers
+        """
+        # Queued threads that aren't in the catalog weren't shown, so they stay queued
+        queueStore.set(board, [
+            thread for thread in queueStore.get(board)
+            if thread.get("no") not in catalogs[board]
+        ] + [
+            thread.toJson()
+            for (no, thread) in catalogs[board].items()
+            if no in selectionNos
+        ])
+        queueStore.save()
+        logger.info("Saved to file")
+        if onSave:
+            onSave(board)
 
     SW = gui.SelectorWindow(
-        "/{}/ threads".format(board),
-        [h[1] for h in headers],
-        tablerows,
-        preSelectionSet,
-        subSaveCallback
+        boards,
+        ["ID"] + [h[1] for h in headers],
+        loadCatalog,
+        saveCallback
     )
 
     # Break out of a higher loop
@@ -468,47 +775,220 @@ def selectImages(board, preSelectedThreads, saveCallback):
     return
 
 
+def autoSelect(board, ruleSet):
+    """Queue a board's catalog threads that match the selection rules.
+    Nothing is dropped here: queued threads missing from the catalog may be archived,
+    and get their final save before the download drops them.
+
+    Args:
+        board (str): Board acronym
+        ruleSet (RuleSet): Compiled selection rules
+
+    Returns:
+        int: Number of newly queued threads
+    """
+    selection = ruleSet.select(board, getThreads(board))
+    added = queueStore.add(board, [thread.toJson() for thread in selection])
+    if added:
+        logger.info("Queued {} new threads on /{}/".format(added, board))
+    return added
+
+
+def autoSelectAll(boards, ruleSet, workers=DEFAULT_BOARD_WORKERS):
+    """Apply the selection rules to every board's catalog and save the queue.
+
+    Args:
+        boards (List): Board acronyms
+        ruleSet (RuleSet): Compiled selection rules
+        workers (int, optional): Number of catalogs to fetch at once
+    """
+    with loom.Spool(workers) as spool:
+        for board in boards:
+            if ruleSet.forBoard(board):
+                spool.enqueue(name=board, target=autoSelect, args=(board, ruleSet,))
+        spool.finish()
+    queueStore.save()
+
+
+def saveState():
+    """Persist the download queue and all caches that changed."""
+    queueStore.save()
+    validatorCache.save()
+    checkpoints.save()
+    fileIndex.save()
+    writeMetrics()
+
+
+def writeMetrics():
+    """Write the run's metrics so far: a json summary to the runMetrics jobj file,
+    and a Prometheus text file if one was asked for."""
+    with metricsLock:
+        ju.json_save(metrics.summary(), "runMetrics")
+        if prometheusPath:
+            metrics.writePrometheus(prometheusPath)
+
+
 def handleThread404(board, threadno):
-    downloadQueue = ju.json_load("downloadQueue", default={})
-    for thread in (t for t in downloadQueue[board] if t["no"] == threadno):
-        downloadQueue[board].remove(thread)
-    ju.json_save(downloadQueue, "downloadQueue")
+    handleThreads404(board, [threadno])
 
 
-def main():
+def handleThreads404(board, threadnos):
+    """Drop dead threads from the download queue.
+    The queue is written out with the other caches, not once per thread.
+    
+    Args:
+        board (str): Board acronym
+        threadnos (List): Thread numerical ids
+    """
+    for threadno in threadnos:
+        checkpoints.forget(board, threadno)
+        validatorCache.forget(getBackend(board).url("thread", board=board, no=threadno))
+    queueStore.remove(board, threadnos)
+
+
+# Watch mode
+
+
+def nextPollInterval(thread, previous):
+    """Decide how long to wait before polling a thread again.
+    Threads are polled about four times per gap since their last post, so active
+    threads are polled often and quiet ones rarely. Unchanged threads back off.
+
+    Args:
+        thread (Thread): Thread from this poll, or None if nothing changed
+        previous (float): The last interval used, or None
+
+    Returns:
+        float: Seconds to wait
+    """
+    if thread is None:
+        interval = (previous or WATCH_MIN_INTERVAL) * WATCH_BACKOFF
+    else:
+        lastPostTime = thread.posts[-1].time
+        interval = (time.time() - lastPostTime) / 4
+    return min(max(interval, WATCH_MIN_INTERVAL), WATCH_MAX_INTERVAL)
 
-    # Load
-    boards = loadBoards().get("4chan")
-    downloadQueue = ju.json_load("downloadQueue", default={})
+
+def watchThread(board, threadno, schedule, scheduleLock):
+    """Poll one thread and schedule its next poll.
+
+    Args:
+        board (str): Board acronym
+        threadno (int): Thread numerical id
+        schedule (Dict): (board, threadno) -> (next poll time, interval), updated in place
+        scheduleLock (threading.Lock): Guards `schedule`
+    """
+    thread = saveThread(board, threadno)
+    if thread and thread.archived:
+        return
+
+    with scheduleLock:
+        (__, previous) = schedule.get((board, threadno), (None, None))
+        interval = nextPollInterval(thread, previous)
+        schedule[(board, threadno)] = (time.time() + interval, interval)
+
+
+def watch(workers=DEFAULT_TOTAL_THREAD_WORKERS, boards=None, ruleSet=None):
+    """Poll every queued thread forever, without the selection GUI.
+    The download queue is reread each cycle, so selections saved elsewhere are picked up.
+
+    Args:
+        workers (int, optional): Number of threads to poll at once
+        boards (List, optional): Board acronyms to apply the rules to
+        ruleSet (RuleSet, optional): Selection rules, to queue new matching threads as they appear
+    """
+    schedule = {}
+    scheduleLock = threading.Lock()
+    nextCatalogs = 0
+    while True:
+        queueStore.reload()
+        if ruleSet and time.time() >= nextCatalogs:
+            autoSelectAll(boards, ruleSet)
+            nextCatalogs = time.time() + WATCH_CATALOG_INTERVAL
+        queued = queueStore.threadnos()
+        with scheduleLock:
+            for key in list(schedule.keys()):
+                if key not in queued:
+                    schedule.pop(key)
+            now = time.time()
+            due = [key for key in queued if schedule.get(key, (0, None))[0] <= now]
+
+        if due:
+            logger.info("Polling {} of {} threads".format(len(due), len(queued)))
+            with loom.Spool(workers) as spool:
+                for (board, threadno) in due:
+                    spool.enqueue(
+                        name=str(threadno), target=watchThread,
+                        args=(board, threadno, schedule, scheduleLock,))
+                spool.finish()
+            saveState()
+
+        with scheduleLock:
+            nextPoll = min([when for (when, interval) in schedule.values()] or [time.time() + WATCH_MIN_INTERVAL])
+        time.sleep(min(max(nextPoll - time.time(), 1), WATCH_MIN_INTERVAL))
+
+
+def main():
+    args = getArgs()
+    boards = loadBoardBackends()
+    downloader.configure(workers=args.workers, rate=args.rate)
+    if args.api_rate:
+        setApiRate(args.api_rate)
+
+    global threadSlots, prometheusPath
+    threadSlots = PrioritySlots(args.total_threads)
+    prometheusPath = args.prometheus
+
+    if args.migrate:
+        migrateLegacyPaths(dryrun=args.dry_run)
+        return
+
+    if args.reindex:
+        fileIndex.reindex()
+        return
+
+    if args.import_json:
+        threadArchive.importJsonFiles()
+        return
+
+    if args.search:
+        searchArchive(args.search)
+        return
+
+    if args.render:
+        regenerateLogs()
+        return
+
+    ruleSet = loadRules() if args.auto else None
+
+    if args.watch:
+        watch(workers=args.total_threads, boards=boards, ruleSet=ruleSet)
+        return
+
+    # Boards start downloading as soon as their selection is saved
+    pipeline = DownloadPipeline(
+        lambda board, progress: saveThreads(board, queueStore.get(board), args.threads, progress),
+        args.boards
+    )
+    pipeline.start()
 
     # Get selections
-    try:
-        for board in boards:
-            oldSelection = (downloadQueue.get(board) or [])
-            downloadQueue[board] = oldSelection  # Fallback
-
-            def saveCallback(selection):
-                """Summary
-                
-                Args:
-                    selection (TYPE): Description
-                """
-                downloadQueue[board] = selection
-                ju.json_save(downloadQueue, "downloadQueue")
-                logger.info("Saved to file")
-
-            selectImages(board, oldSelection, saveCallback)
-
-    except KeyboardInterrupt:
-        logger.info("Selections canceled, jumping straight to downloading threads. ")
-        ju.json_save(downloadQueue, "downloadQueue")
-        logger.info("Saved to file")
+    if ruleSet:
+        autoSelectAll(boards, ruleSet, workers=args.boards)
+    else:
+        try:
+            selectThreads(boards, onSave=pipeline.submit)
+        except KeyboardInterrupt:
+            logger.info("Selections canceled, jumping straight to downloading threads. ")
+            queueStore.save()
+            logger.info("Saved to file")
 
-    # Run downloads
-    for board in list(downloadQueue.keys()):
-        queueList = downloadQueue.get(board)
-        saveThreads(board, queueList)
+    # Download whatever else is queued
+    pipeline.finish(queueStore.boards())
+    saveState()
 
 
 if __name__ == "__main__":
+    # Render workers of a frozen (PyInstaller) build would otherwise rerun the whole program
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,261 @@
+import html
+import json
+import os
+import re
+import sqlite3
+import threading
+import zlib
+
+from json.decoder import JSONDecodeError
+
+from snip.stream import TriadLogger
+logger = TriadLogger(__name__)
+
+# Posts are small, so each one is compressed against a preset dictionary of the
+# keys and values posts have in common. Changing it makes old rows unreadable,
+# so any change needs a new FORMAT_VERSION.
+FORMAT_VERSION = 1
+ZDICT = (
+    b'{"no": , "resto": 0, "sticky": 1, "closed": 1, "now": "", "time": , "name": "Anonymous", '
+    b'"trip": "", "id": "", "capcode": "", "country": "", "country_name": "", "board_flag": "", '
+    b'"flag_name": "", "sub": "", "com": "<a href=\\"#p\\" class=\\"quotelink\\">&gt;&gt;</a><br>'
+    b'<span class=\\"quote\\">&gt;</span><wbr>", "tim": , "filename": "", "ext": ".jpg", ".png", '
+    b'".gif", ".webm", ".mp4", "fsize": , "md5": "==", "w": , "h": , "tn_w": , "tn_h": , '
+    b'"filedeleted": 1, "spoiler": 1, "custom_spoiler": , "replies": , "images": , "bumplimit": 1, '
+    b'"imagelimit": 1, "tag": "", "semantic_url": "", "unique_ips": , "archived": 1, "archived_on": , '
+    b'"m_img": 1, "since4pass": }'
+)
+
+
+# Full text search rowids pack the board id above the post number, which is unique per board
+BOARD_ID_SHIFT = 40
+TAG_PATTERN = re.compile(r"<[^>]+>")
+# Queries using any of these are passed to FTS5 as they are
+FTS_SYNTAX_PATTERN = re.compile(r'["*():^{}]|\b(AND|OR|NOT|NEAR)\b')
+
+
+def postText(value):
+    """Plain text of an html post field, for indexing."""
+    return html.unescape(TAG_PATTERN.sub(" ", value)) if value else None
+
+
+def ftsQuery(query):
+    """Quote each word of a plain query, so punctuation like `don't` or `c++` isn't read as FTS5 syntax.
+    Queries that use FTS5 syntax are left alone.
+
+    Args:
+        query (str): Search query
+
+    Returns:
+        str: FTS5 query
+    """
+    if FTS_SYNTAX_PATTERN.search(query):
+        return query
+    return " ".join('"{}"'.format(word) for word in query.split())
+
+
+def compressPost(post):
+    compressor = zlib.compressobj(9, zdict=ZDICT)
+    return compressor.compress(json.dumps(post, separators=(",", ":")).encode("utf-8")) + compressor.flush()
+
+
+def decompressPost(data):
+    decompressor = zlib.decompressobj(zdict=ZDICT)
+    return json.loads((decompressor.decompress(data) + decompressor.flush()).decode("utf-8"))
+
+
+class ThreadArchive():
+    """All saved thread json in one SQLite database, one compressed row per post.
+
+    New posts are added to a thread's rows rather than rewriting the thread, and
+    the thread table indexes every thread by board and number. Post text is kept
+    in a full text index, updated in the same transaction as the posts.
+    """
+
+    def __init__(self, dbpath="./text/archive.sqlite3"):
+        """
+        Args:
+            dbpath (str, optional): Database location
+        """
+        self.dbpath = dbpath
+        self.lock = threading.Lock()
+        self.boardIds = {}
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.dbpath), exist_ok=True)
+            self._db = sqlite3.connect(self.dbpath, check_same_thread=False)
+            with self._db:
+                self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+                self._db.execute("""CREATE TABLE IF NOT EXISTS threads (
+                    board TEXT NOT NULL,
+                    no INTEGER NOT NULL,
+                    semantic_url TEXT,
+                    last_post INTEGER,
+                    PRIMARY KEY (board, no)
+                )""")
+                self._db.execute("""CREATE TABLE IF NOT EXISTS posts (
+                    board TEXT NOT NULL,
+                    no INTEGER NOT NULL,
+                    thread INTEGER NOT NULL,
+                    time INTEGER,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (board, no)
+                )""")
+                self._db.execute("CREATE INDEX IF NOT EXISTS posts_thread ON posts (board, thread, no)")
+                self._db.execute("CREATE TABLE IF NOT EXISTS boards (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+                self._db.execute("INSERT OR IGNORE INTO meta VALUES ('format', ?)", (FORMAT_VERSION,))
+            (version,) = self._db.execute("SELECT value FROM meta WHERE key = 'format'").fetchone()
+            if version != FORMAT_VERSION:
+                raise ValueError("{} is archive format {}, expected {}".format(self.dbpath, version, FORMAT_VERSION))
+            self._createSearchIndex()
+        return self._db
+
+    def _createSearchIndex(self):
+        exists = self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'post_text'").fetchone()
+        if exists:
+            return
+        with self._db:
+            self._db.execute("""CREATE VIRTUAL TABLE post_text USING fts5 (
+                board UNINDEXED, thread UNINDEXED, no UNINDEXED,
+                sub, com, name, filename,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )""")
+            # Archives from before the search index get indexed once, here
+            rows = self._db.execute("SELECT board, thread, data FROM posts")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO post_text (rowid, board, thread, no, sub, com, name, filename) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [self._searchRow(board, thread, decompressPost(data)) for (board, thread, data) in rows.fetchall()]
+            )
+
+    def _boardId(self, board):
+        # Caller holds the lock
+        boardId = self.boardIds.get(board)
+        if boardId is None:
+            self._db.execute("INSERT OR IGNORE INTO boards (name) VALUES (?)", (board,))
+            (boardId,) = self._db.execute("SELECT id FROM boards WHERE name = ?", (board,)).fetchone()
+            self.boardIds[board] = boardId
+        return boardId
+
+    def _searchRow(self, board, threadno, post):
+        return (
+            (self._boardId(board) << BOARD_ID_SHIFT) | post.get("no"),
+            board, threadno, post.get("no"),
+            postText(post.get("sub")), postText(post.get("com")), postText(post.get("name")),
+            post.get("filename")
+        )
+
+    def savePosts(self, board, threadno, sem, posts):
+        """Add or update posts of a thread, in one transaction.
+
+        Args:
+            board (str): Board acronym
+            threadno (int): Thread numerical id
+            sem (str): Thread semantic url (text id)
+            posts (List): Raw post json objects
+        """
+        if not posts:
+            return
+        rows = [
+            (board, post.get("no"), threadno, post.get("time"), compressPost(post))
+            for post in posts
+        ]
+        with self.lock:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?)", rows)
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO post_text (rowid, board, thread, no, sub, com, name, filename) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [self._searchRow(board, threadno, post) for post in posts]
+                )
+                self.db.execute(
+                    "INSERT INTO threads VALUES (?, ?, ?, ?) ON CONFLICT (board, no) DO UPDATE SET "
+                    "semantic_url = excluded.semantic_url, last_post = max(last_post, excluded.last_post)",
+                    (board, threadno, sem, max(row[1] for row in rows))
+                )
+
+    def loadThread(self, board, threadno):
+        """
+        Args:
+            board (str): Board acronym
+            threadno (int): Thread numerical id
+
+        Returns:
+            Dict: Thread json, as the API would give it, or None if it isn't archived
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT data FROM posts WHERE board = ? AND thread = ? ORDER BY no", (board, threadno)
+            ).fetchall()
+        if not rows:
+            return None
+        return {"posts": [decompressPost(data) for (data,) in rows]}
+
+    def search(self, query, limit=50):
+        """Full text search over post subjects, comments, names and file names.
+
+        Args:
+            query (str): Words, or an SQLite FTS5 query, i.e. `cat OR dog`, `sub:ygyl`, `"exact phrase"`
+            limit (int, optional): Max results
+
+        Returns:
+            List: Tuples of (board, thread number, semantic url, snippet, post json), best first
+
+        Raises:
+            ValueError: The query isn't valid FTS5 syntax
+        """
+        with self.lock:
+            try:
+                rows = self.db.execute(
+                    "SELECT post_text.board, post_text.thread, threads.semantic_url, "
+                    "snippet(post_text, -1, '[', ']', '...', 12), posts.data "
+                    "FROM post_text "
+                    "JOIN posts ON posts.board = post_text.board AND posts.no = post_text.no "
+                    "LEFT JOIN threads ON threads.board = post_text.board AND threads.no = post_text.thread "
+                    "WHERE post_text MATCH ? ORDER BY rank LIMIT ?",
+                    (ftsQuery(query), limit)
+                ).fetchall()
+            except sqlite3.OperationalError as e:
+                raise ValueError("Bad search query {!r}: {}".format(query, e)) from e
+        return [
+            (board, threadno, sem, snippet, decompressPost(data))
+            for (board, threadno, sem, snippet, data) in rows
+        ]
+
+    def threads(self):
+        """
+        Returns:
+            List: (board, thread number) of every archived thread
+        """
+        with self.lock:
+            return self.db.execute("SELECT board, no FROM threads ORDER BY board, no").fetchall()
+
+    def importJsonFiles(self, root="./text"):
+        """Import thread json files saved by older versions. The files are left in place.
+
+        Args:
+            root (str, optional): Text log folder
+
+        Returns:
+            int: Number of threads imported
+        """
+        count = 0
+        for board in sorted(os.listdir(root)):
+            boarddir = os.path.join(root, board)
+            if not os.path.isdir(boarddir):
+                continue
+            for entry in os.scandir(boarddir):
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    with open(entry.path, "r", encoding="utf-8") as jsonfile:
+                        posts = json.load(jsonfile).get("posts")
+                    self.savePosts(board, posts[0].get("no"), posts[0].get("semantic_url"), posts)
+                    count += 1
+                except (OSError, JSONDecodeError, IndexError, AttributeError):
+                    logger.error("Error importing {}".format(entry.path), exc_info=True)
+        logger.info("Imported {} threads".format(count))
+        return count
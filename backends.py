@@ -0,0 +1,104 @@
+import urllib.parse
+
+from snip import jfileutil as ju
+from engine import setApiRate
+
+from snip.stream import TriadLogger
+logger = TriadLogger(__name__)
+
+# API mappings for each supported server. Urls are format strings taking
+# {board}, {no}, {tim} and {ext}. "fields" maps our post field names to the
+# site's, where they differ. Rates are requests per second per host; workers
+# cap concurrent media downloads from the site.
+DEFAULT_MAPPINGS = {
+    "4chan": {
+        "urls": {
+            "catalog": "https://a.4cdn.org/{board}/catalog.json",
+            "thread": "https://a.4cdn.org/{board}/thread/{no}.json",
+            "threads": "https://a.4cdn.org/{board}/threads.json",
+            "archive": "https://a.4cdn.org/{board}/archive.json",
+            "media": "https://i.4cdn.org/{board}/{tim}{ext}"
+        },
+        "fields": {},
+        "apiRate": 1,
+        "mediaRate": 5,
+        "mediaWorkers": 6
+    }
+}
+
+DEFAULT_SERVER = "4chan"
+
+
+class Backend():
+    """One imageboard's API, as described by its mappings."""
+
+    def __init__(self, name, mapping):
+        """
+        Args:
+            name (str): Server name, as used in the Boards file
+            mapping (Dict): The server's entry in the mappings file
+        """
+        self.name = name
+        self.urls = mapping.get("urls")
+        self.fields = mapping.get("fields") or {}
+        self.apiRate = mapping.get("apiRate")
+        self.mediaRate = mapping.get("mediaRate")
+        self.mediaWorkers = mapping.get("mediaWorkers")
+
+    def url(self, kind, **kwargs):
+        """
+        Args:
+            kind (str): One of catalog, thread, threads, archive, media
+            **kwargs: Url fields
+
+        Returns:
+            str: The url, or None if the site has no such endpoint
+        """
+        template = self.urls.get(kind)
+        return template.format(**kwargs) if template else None
+
+    def hosts(self, *kinds):
+        """
+        Args:
+            *kinds (str): Url kinds
+
+        Returns:
+            Set: Host names the given kinds of url point at
+        """
+        return set(
+            urllib.parse.urlsplit(self.urls.get(kind)).netloc
+            for kind in kinds
+            if self.urls.get(kind)
+        )
+
+    def register(self, downloader):
+        """Apply this site's rate limits and concurrency caps.
+
+        Args:
+            downloader (DownloadEngine): Shared media engine
+        """
+        for host in self.hosts("catalog", "thread", "threads", "archive"):
+            if self.apiRate:
+                setApiRate(self.apiRate, host)
+        for host in self.hosts("media"):
+            downloader.setHostLimits(host, self.mediaRate, self.mediaWorkers)
+
+
+def loadBackends():
+    """Load API mappings from file, handling defaults if needed.
+    Servers missing from the file fall back to the built-in mappings.
+
+    Returns:
+        Dict: Key: server, Value: Backend
+    """
+    filename = "Backends"
+    mappings = dict(DEFAULT_MAPPINGS)
+    try:
+        mappings.update(ju.json_load(filename))
+    except FileNotFoundError:
+        ju.json_save(DEFAULT_MAPPINGS, filename)
+        logger.info("Missing the backends file. A default has been generated.")
+    return {
+        name: Backend(name, mapping)
+        for (name, mapping) in mappings.items()
+    }
@@ -0,0 +1,509 @@
+#!/bin/python3
+"""Offline benchmark: runs 4chan.py against a local stand-in for the 4chan API.
+
+The fake site serves synthetic boards, with catalogs, thread lists, archives,
+threads and media, from a seeded generator, so every run sees the same data.
+Each benchmark downloads everything once into an empty folder (cold), then
+again after some threads get new posts or are touched (warm). Results are
+printed and added to a json lines file, tagged with the git commit, so runs
+can be compared across commits.
+"""
+import base64
+import email.utils
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from snip import jfileutil as ju
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "4chan.py")
+SERVER = "bench"
+THREADS_PER_PAGE = 15
+BLOCK_SIZE = 4096
+EXTS = (".jpg", ".png", ".gif", ".webm")
+
+# Runs the script, then writes the process' io counters out for the parent
+WRAPPER = """
+import atexit, json, os, runpy, sys
+def dumpIo(path=sys.argv[1]):
+    try:
+        with open("/proc/self/io") as fp:
+            counters = dict(line.split(": ") for line in fp.read().splitlines())
+    except OSError:
+        counters = {}
+    with open(path, "w") as fp:
+        json.dump({key: int(value) for (key, value) in counters.items()}, fp)
+atexit.register(dumpIo)
+sys.argv = sys.argv[2:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def mediaBlock(tim):
+    return hashlib.sha256(str(tim).encode()).digest() * (BLOCK_SIZE // 32)
+
+
+def mediaBytes(tim, size, start=0):
+    """Generate a media file's content, from `start` on, in blocks.
+
+    Args:
+        tim (int): The file's timestamp id, which seeds its content
+        size (int): File size
+        start (int, optional): Offset to start from
+
+    Yields:
+        bytes
+    """
+    block = mediaBlock(tim)
+    offset = start
+    while offset < size:
+        chunk = block[offset % BLOCK_SIZE:min(BLOCK_SIZE, offset % BLOCK_SIZE + size - offset)]
+        yield chunk
+        offset += len(chunk)
+
+
+class FakeSite():
+    """Synthetic boards, threads, posts and files, all derived from one seed.
+
+    Each generation, a share of threads stays unchanged, so the thread list tells
+    the downloader to skip them. A share is touched: its last_modified moves but
+    its posts don't, so it is fetched again and answers the conditional request
+    with 304. The rest get new posts. A share of threads are listed but answer
+    404, as if they died just after the list was fetched.
+    """
+
+    def __init__(self, boards=2, threads=20, posts=30, fileRatio=0.5, fileSize=64 * 1024,
+                 p404=0.05, pUnchanged=0.7, pTouched=0.1, seed=1):
+        """
+        Args:
+            boards (int, optional): Number of boards
+            threads (int, optional): Threads per board
+            posts (int, optional): Posts per thread, at the first generation
+            fileRatio (float, optional): Share of posts with a file
+            fileSize (int, optional): Mean file size in bytes
+            p404 (float, optional): Share of threads that 404
+            pUnchanged (float, optional): Share of threads unchanged between generations
+            pTouched (float, optional): Share of threads whose last_modified moves without new posts
+            seed (int, optional): Random seed
+        """
+        self.boards = ["b{}".format(i) for i in range(boards)]
+        self.threadCount = threads
+        self.postCount = posts
+        self.fileRatio = fileRatio
+        self.fileSize = fileSize
+        self.p404 = p404
+        self.pUnchanged = pUnchanged
+        self.pTouched = pTouched
+        self.seed = seed
+        self.generation = 0
+        self.lock = threading.RLock()
+        self.stats = {}
+        self.md5s = {}
+        self.build()
+
+    def build(self):
+        """(Re)generate every board for the current generation."""
+        self.threads = {}  # (board, no) -> post json list
+        self.dead = set()
+        self.media = {}  # (board, tim) -> size
+        self.modified = {}  # (board, no) -> last_modified
+        baseTime = 1600000000
+        for (b, board) in enumerate(self.boards):
+            for t in range(self.threadCount):
+                no = (b + 1) * 10 ** 6 + t * 1000
+                threadRand = random.Random("{}-{}-{}".format(self.seed, board, no))
+                if threadRand.random() < self.p404:
+                    self.dead.add((board, no))
+                # Threads that churned in any generation so far have that many extra batches of posts,
+                # and ones that were touched have their last_modified moved a second per touch
+                extra = 0
+                touches = 0
+                for gen in range(1, self.generation + 1):
+                    roll = random.Random("{}-{}-{}-{}".format(self.seed, board, no, gen)).random()
+                    if roll >= self.pUnchanged + self.pTouched:
+                        extra += 1
+                    elif roll >= self.pUnchanged:
+                        touches += 1
+                count = self.postCount + extra * max(1, self.postCount // 5)
+                posts = [self.makePost(board, no, no + i, baseTime + t * 60 + i * 30, threadRand, i == 0)
+                         for i in range(count)]
+                op = posts[0]
+                op.update(
+                    replies=count - 1,
+                    images=sum(1 for post in posts[1:] if "tim" in post),
+                    semantic_url="thread-{}-{}".format(board, t),
+                    sub="Thread {} of /{}/".format(t, board),
+                    bumplimit=1 if count > 300 else 0
+                )
+                self.threads[(board, no)] = posts
+                self.modified[(board, no)] = posts[-1]["time"] + touches
+
+    def makePost(self, board, threadno, no, when, rand, isOp):
+        post = {
+            "no": no,
+            "resto": 0 if isOp else threadno,
+            "now": time.strftime("%m/%d/%y(%a)%H:%M:%S", time.gmtime(when)),
+            "time": when,
+            "name": "Anonymous",
+            "com": "Post {} &gt;&gt;{}<br>Lorem ipsum dolor sit amet".format(no, threadno)
+        }
+        if isOp or rand.random() < self.fileRatio:
+            tim = when * 1000 + no % 1000
+            size = max(1, int(rand.expovariate(1 / self.fileSize)))
+            key = (board, tim)
+            if key not in self.md5s:
+                digest = hashlib.md5()
+                for chunk in mediaBytes(tim, size):
+                    digest.update(chunk)
+                self.md5s[key] = base64.b64encode(digest.digest()).decode("ascii")
+            self.media[key] = size
+            post.update(
+                tim=tim, filename="file{}".format(no), ext=EXTS[no % len(EXTS)],
+                fsize=size, md5=self.md5s[key], w=640, h=480
+            )
+        return post
+
+    def advance(self):
+        """Move to the next generation, where some threads have new posts and some are touched."""
+        with self.lock:
+            self.generation += 1
+            self.build()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def resetStats(self):
+        with self.lock:
+            (stats, self.stats) = (self.stats, {})
+        return stats
+
+    def live(self, board):
+        return sorted(
+            [no for (b, no) in self.threads if b == board],
+            key=lambda no: -self.modified[(board, no)]
+        )
+
+    def pages(self, board, fields):
+        threads = self.live(board)
+        return [
+            {"page": p + 1, "threads": [fields(no) for no in threads[i:i + THREADS_PER_PAGE]]}
+            for (p, i) in enumerate(range(0, len(threads), THREADS_PER_PAGE))
+        ]
+
+    def catalog(self, board):
+        return self.pages(board, lambda no: dict(self.threads[(board, no)][0], last_replies=self.threads[(board, no)][-5:]))
+
+    def threadList(self, board):
+        return self.pages(board, lambda no: {
+            "no": no,
+            "last_modified": self.modified[(board, no)],
+            "replies": len(self.threads[(board, no)]) - 1
+        })
+
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    site = None
+    latency = 0
+    bandwidth = 0
+
+    ROUTES = [
+        (re.compile(r"^/(\w+)/catalog\.json$"), "catalog"),
+        (re.compile(r"^/(\w+)/threads\.json$"), "threads"),
+        (re.compile(r"^/(\w+)/archive\.json$"), "archive"),
+        (re.compile(r"^/(\w+)/thread/(\d+)\.json$"), "thread"),
+        (re.compile(r"^/media/(\w+)/(\d+)\.\w+$"), "media"),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        site = self.site
+        site.count("requests")
+        response = None
+        route = None
+        with site.lock:
+            for (pattern, kind) in self.ROUTES:
+                match = pattern.match(self.path)
+                if not match or match.group(1) not in site.boards:
+                    continue
+                (route, board) = (kind, match.group(1))
+                if kind == "media":
+                    size = site.media.get((board, int(match.group(2))))
+                    if size is not None:
+                        response = ("media", (int(match.group(2)), size))
+                elif kind == "thread":
+                    no = int(match.group(2))
+                    if (board, no) in site.threads and (board, no) not in site.dead:
+                        posts = site.threads[(board, no)]
+                        response = ("json", ({"posts": posts}, "{}-{}-{}".format(board, no, len(posts)),
+                                             site.modified[(board, no)], len(posts)))
+                elif kind == "catalog":
+                    response = ("json", (site.catalog(board), "{}-catalog-{}".format(board, site.generation), None, 0))
+                elif kind == "threads":
+                    response = ("json", (site.threadList(board), "{}-threads-{}".format(board, site.generation), None, 0))
+                elif kind == "archive":
+                    response = ("json", ([], "{}-archive".format(board), None, 0))
+                break
+
+        if route == "thread":
+            site.count("thread_requests")
+        if response is None:
+            site.count("404")
+            self.sendBody(404, b"Not Found", "text/plain")
+        elif response[0] == "media":
+            self.sendMedia(*response[1])
+        else:
+            (obj, etag, lastModified, posts) = response[1]
+            if self.sendJson(obj, etag, lastModified):
+                site.count("thread_posts", posts)
+            elif route == "thread":
+                site.count("thread_304")
+
+    def sendBody(self, status, body, contentType, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        for (key, value) in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendJson(self, obj, etag, lastModified=None):
+        """
+        Returns:
+            bool: Whether the body was sent, rather than a 304
+        """
+        etag = '"{}"'.format(etag)
+        headers = {"ETag": etag}
+        if lastModified:
+            headers["Last-Modified"] = email.utils.formatdate(lastModified, usegmt=True)
+        if self.headers.get("If-None-Match") == etag:
+            self.site.count("304")
+            self.send_response(304)
+            for (key, value) in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return False
+        body = json.dumps(obj).encode("utf-8")
+        self.site.count("api_bytes", len(body))
+        self.sendBody(200, body, "application/json", headers)
+        return True
+
+    def sendMedia(self, tim, size):
+        start = 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range") or "")
+        if match:
+            start = int(match.group(1))
+            if start >= size:
+                return self.sendBody(416, b"", "text/plain")
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        self.site.count("media_files")
+        self.site.count("media_bytes", size - start)
+        for chunk in mediaBytes(tim, size, start):
+            self.wfile.write(chunk)
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+
+
+def startServer(site, latency=0, bandwidth=0):
+    """
+    Args:
+        site (FakeSite): Data to serve
+        latency (float, optional): Seconds added to every request
+        bandwidth (float, optional): Bytes per second per media response; unlimited if 0
+
+    Returns:
+        ThreadingHTTPServer: Running server, on a free port of 127.0.0.1
+    """
+    handler = type("Handler", (FakeApiHandler,), {"site": site, "latency": latency, "bandwidth": bandwidth})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="FakeApi", daemon=True).start()
+    return server
+
+
+def writeConfig(workdir, site, apiServer, mediaServer, args):
+    """Point a fresh work folder's Backends, Boards and Rules files at the fake site."""
+    root = "http://127.0.0.1:{}".format(apiServer.server_address[1])
+    mediaRoot = "http://127.0.0.1:{}".format(mediaServer.server_address[1])
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        ju.json_save({
+            SERVER: {
+                "urls": {
+                    "catalog": root + "/{board}/catalog.json",
+                    "thread": root + "/{board}/thread/{no}.json",
+                    "threads": root + "/{board}/threads.json",
+                    "archive": root + "/{board}/archive.json",
+                    "media": mediaRoot + "/media/{board}/{tim}{ext}"
+                },
+                "fields": {},
+                "apiRate": args.api_rate,
+                "mediaRate": args.media_rate,
+                "mediaWorkers": args.media_workers
+            }
+        }, "Backends")
+        ju.json_save({SERVER: site.boards}, "Boards")
+        # A rule without conditions selects every thread
+        ju.json_save([{}], "Rules")
+    finally:
+        os.chdir(cwd)
+
+
+def runScript(workdir, scriptArgs):
+    """Run 4chan.py once in a work folder.
+
+    Returns:
+        Tuple: (wall seconds, io counters of the process, exit code)
+    """
+    iopath = os.path.join(workdir, "bench-io.txt")
+    command = [sys.executable, "-c", WRAPPER, iopath, SCRIPT, "--auto"] + scriptArgs
+    start = time.monotonic()
+    proc = subprocess.run(command, cwd=workdir, stdout=subprocess.DEVNULL)
+    wall = time.monotonic() - start
+    if proc.returncode:
+        print("4chan.py exited with code {}; this run's numbers are not valid".format(proc.returncode))
+    try:
+        with open(iopath, "r") as fp:
+            io = json.load(fp)
+    except (OSError, ValueError):
+        io = {}
+    return (wall, io, proc.returncode)
+
+
+def measure(label, site, workdir, scriptArgs):
+    site.resetStats()
+    (wall, io, code) = runScript(workdir, scriptArgs)
+    stats = site.resetStats()
+    posts = stats.get("thread_posts", 0)
+    # Threads the downloader actually asked for; unchanged ones are skipped
+    threads = stats.get("thread_requests", 0)
+    syscalls = io.get("syscr", 0) + io.get("syscw", 0)
+    return {
+        "run": label,
+        "exit": code,
+        "seconds": round(wall, 3),
+        "threads_fetched": threads,
+        "threads_per_sec": round(threads / wall, 2),
+        "mb_per_sec": round(stats.get("media_bytes", 0) / wall / 1e6, 3),
+        "io_syscalls_per_post": round(syscalls / posts, 2) if posts else None,
+        "requests": stats.get("requests", 0),
+        "not_modified": stats.get("304", 0),
+        "threads_not_modified": stats.get("thread_304", 0),
+        "not_found": stats.get("404", 0),
+        "media_files": stats.get("media_files", 0),
+        "media_bytes": stats.get("media_bytes", 0),
+        "posts_served": posts
+    }
+
+
+def gitCommit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(SCRIPT),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def getArgs():
+    import argparse
+    ap = argparse.ArgumentParser(description="Benchmark 4chan.py against a local fake 4chan API")
+    ap.add_argument("--boards", type=int, default=2, help="Number of boards. Default is 2")
+    ap.add_argument("--threads", type=int, default=20, help="Threads per board. Default is 20")
+    ap.add_argument("--posts", type=int, default=30, help="Posts per thread. Default is 30")
+    ap.add_argument("--file-ratio", type=float, default=0.5, help="Share of posts with a file. Default is 0.5")
+    ap.add_argument("--file-size", type=int, default=64 * 1024, help="Mean file size in bytes. Default is 65536")
+    ap.add_argument("--latency", type=float, default=0.02, help="Seconds added to every request. Default is 0.02")
+    ap.add_argument("--bandwidth", type=float, default=0,
+                    help="Bytes per second per media response. Default is 0, unlimited")
+    ap.add_argument("--p404", type=float, default=0.05, help="Share of threads that 404. Default is 0.05")
+    ap.add_argument("--unchanged", type=float, default=0.7,
+                    help="Share of threads unchanged between runs, which the downloader skips. Default is 0.7")
+    ap.add_argument("--touched", type=float, default=0.1,
+                    help="Share of threads whose last_modified moves between runs without new posts, "
+                    "which are fetched again and answer 304. Default is 0.1")
+    ap.add_argument("--warm-runs", type=int, default=1, help="Number of warm runs. Default is 1")
+    ap.add_argument("--seed", type=int, default=1, help="Random seed for the synthetic data. Default is 1")
+    ap.add_argument("--api-rate", type=float, default=1000, help="API requests per second. Default is 1000")
+    ap.add_argument("--media-rate", type=float, default=1000, help="Media requests per second. Default is 1000")
+    ap.add_argument("--media-workers", type=int, default=6, help="Concurrent media downloads. Default is 6")
+    ap.add_argument("--script-args", default="", help="Extra arguments for 4chan.py, i.e. '--total-threads 16'")
+    ap.add_argument("--results", default="bench-results.jsonl",
+                    help="Json lines file to add results to. Default is bench-results.jsonl")
+    ap.add_argument("--keep", action="store_true", help="Keep the work folder")
+    return ap.parse_args()
+
+
+def main():
+    args = getArgs()
+    site = FakeSite(
+        boards=args.boards, threads=args.threads, posts=args.posts,
+        fileRatio=args.file_ratio, fileSize=args.file_size,
+        p404=args.p404, pUnchanged=args.unchanged, pTouched=args.touched, seed=args.seed
+    )
+    # Separate API and media hosts, as on the real site, so each gets its own sessions and limits
+    servers = [startServer(site, latency=args.latency, bandwidth=args.bandwidth) for i in range(2)]
+    workdir = tempfile.mkdtemp(prefix="4chandl-bench-")
+    scriptArgs = shlex.split(args.script_args)
+    try:
+        writeConfig(workdir, site, servers[0], servers[1], args)
+        runs = [measure("cold", site, workdir, scriptArgs)]
+        for i in range(args.warm_runs):
+            site.advance()
+            runs.append(measure("warm", site, workdir, scriptArgs))
+    finally:
+        for server in servers:
+            server.shutdown()
+        if args.keep:
+            print("Work folder:", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "commit": gitCommit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "params": {
+            key: value for (key, value) in vars(args).items()
+            if key not in ("results", "keep")
+        },
+        "runs": runs
+    }
+    print("{:<6} {:>8} {:>8} {:>5} {:>12} {:>10} {:>14} {:>9}".format(
+        "run", "seconds", "threads", "304", "threads/sec", "MB/s", "syscalls/post", "requests"))
+    for run in runs:
+        print("{:<6} {:>8} {:>8} {:>5} {:>12} {:>10} {:>14} {:>9}".format(
+            run["run"], run["seconds"], run["threads_fetched"], run["threads_not_modified"],
+            run["threads_per_sec"], run["mb_per_sec"], str(run["io_syscalls_per_post"]), run["requests"]))
+    with open(args.results, "a", encoding="utf-8") as fp:
+        fp.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import base64
+import os
+import shutil
+
+from snip.stream import TriadLogger
+logger = TriadLogger(__name__)
+
+BLOB_ROOT = "./saved/.blobs"
+
+
+def blobPath(md5, ext):
+    """Where the single stored copy of a file lives.
+
+    Args:
+        md5 (str): Base64 md5, as given by the API
+        ext (str): File extension, with dot
+
+    Returns:
+        str: Path in the blob store
+    """
+    hexdigest = base64.b64decode(md5).hex()
+    return os.path.join(BLOB_ROOT, hexdigest[:2], hexdigest + ext)
+
+
+def linkFromStore(md5, ext, dstpath):
+    """Hardlink a stored file to `dstpath`, replacing anything already there.
+    Falls back to copying where hardlinks aren't possible.
+
+    Args:
+        md5 (str): Base64 md5, as given by the API
+        ext (str): File extension, with dot
+        dstpath (str): Destination path
+
+    Returns:
+        bool: False if the file isn't stored yet
+    """
+    blob = blobPath(md5, ext)
+    tmppath = dstpath + ".link"
+    try:
+        try:
+            os.link(blob, tmppath)
+        except FileExistsError:
+            os.unlink(tmppath)
+            os.link(blob, tmppath)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # Cross-device or no hardlink support; we still save the download
+            shutil.copyfile(blob, tmppath)
+        os.replace(tmppath, dstpath)
+        return True
+    except OSError:
+        logger.error("Error linking {} to {}".format(blob, dstpath), exc_info=True)
+        return False
+
+
+def addToStore(path, md5, ext):
+    """Make a saved file the stored copy for its md5, if there isn't one yet.
+    The file must already be verified against the md5.
+
+    Args:
+        path (str): Saved file
+        md5 (str): Base64 md5, as given by the API
+        ext (str): File extension, with dot
+    """
+    blob = blobPath(md5, ext)
+    try:
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.link(path, blob)
+    except FileExistsError:
+        pass
+    except OSError:
+        # Without hardlinks, storing a copy would only cost disk
+        logger.debug("Can't link {} into the blob store".format(path), exc_info=True)
@@ -0,0 +1,72 @@
+import threading
+
+from snip import jfileutil as ju
+
+
+class CheckpointStore():
+    """Remembers, per thread, the last post number each stage has fully handled.
+
+    Stages are short names like "log" or "media", so the text log and the
+    image downloads can advance independently.
+    """
+
+    def __init__(self, filename="threadCheckpoints"):
+        """
+        Args:
+            filename (str, optional): Name of the jobj file the checkpoints persist to
+        """
+        self.filename = filename
+        self.checkpoints = ju.json_load(filename, default={})
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    @staticmethod
+    def key(board, threadno):
+        return "{}/{}".format(board, threadno)
+
+    def get(self, board, threadno, stage):
+        """
+        Args:
+            board (str): Board acronym
+            threadno (int): Thread numerical id
+            stage (str): Stage name
+
+        Returns:
+            int: Last handled post number, or 0 if the thread is new to the stage
+        """
+        with self.lock:
+            return self.checkpoints.get(self.key(board, threadno), {}).get(stage, 0)
+
+    def set(self, board, threadno, stage, postno):
+        """Advance a stage's checkpoint.
+
+        Args:
+            board (str): Board acronym
+            threadno (int): Thread numerical id
+            stage (str): Stage name
+            postno (int): Last handled post number
+        """
+        with self.lock:
+            stages = self.checkpoints.setdefault(self.key(board, threadno), {})
+            if stages.get(stage) != postno:
+                stages[stage] = postno
+                self.dirty = True
+
+    def forget(self, board, threadno):
+        """Drop all checkpoints for a thread.
+
+        Args:
+            board (str): Board acronym
+            threadno (int): Thread numerical id
+        """
+        with self.lock:
+            if self.checkpoints.pop(self.key(board, threadno), None) is not None:
+                self.dirty = True
+
+    def save(self):
+        """Write checkpoints to disk, if they changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            ju.json_save(dict(self.checkpoints), self.filename)
+            self.dirty = False
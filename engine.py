@@ -0,0 +1,309 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+import urllib.parse
+
+import requests
+import tqdm
+
+from metrics import metrics
+from requests.adapters import HTTPAdapter
+from snip import loom
+
+from snip.stream import TriadLogger
+logger = TriadLogger(__name__)
+
+DEFAULT_WORKERS = 6
+DEFAULT_RATE = 5  # Requests per second per host, across all workers
+API_RATE = 1  # Per host, unless a backend says otherwise
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 30
+
+
+class RateLimiter():
+    """Token bucket shared by any number of threads.
+    Each call to `wait` consumes one token, blocking until one is available.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        Args:
+            rate (float): Tokens added per second
+            burst (int, optional): Maximum number of tokens held at once
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+_sessions = {}
+_sessionLock = threading.Lock()
+
+
+def getSession(url, poolsize=DEFAULT_WORKERS):
+    """Get the shared keep-alive session for the host of a url.
+
+    Args:
+        url (str): Any url on the host
+        poolsize (int, optional): Max connections kept open to the host
+
+    Returns:
+        requests.Session
+    """
+    host = urllib.parse.urlsplit(url).netloc
+    with _sessionLock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolsize)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+        return session
+
+
+class IntegrityError(Exception):
+    """A download didn't match its expected md5."""
+    pass
+
+
+_apiLimiters = {}
+_apiLimiterLock = threading.Lock()
+
+
+def apiGet(url, **kwargs):
+    """GET an API url over the shared session, respecting its host's API rate limit.
+
+    Args:
+        url (str): API url
+        **kwargs: Passed to requests
+
+    Returns:
+        requests.Response
+    """
+    host = urllib.parse.urlsplit(url).netloc
+    with _apiLimiterLock:
+        limiter = _apiLimiters.get(host)
+        if limiter is None:
+            limiter = _apiLimiters[host] = RateLimiter(API_RATE)
+    start = time.monotonic()
+    limiter.wait()
+    metrics.observe("rate_limit_wait_seconds", time.monotonic() - start, stage="api", host=host)
+    with metrics.timed("api_request", host=host):
+        resp = getSession(url).get(url, timeout=TIMEOUT, **kwargs)
+    metrics.count("requests", stage="api", host=host, status=resp.status_code)
+    metrics.count("bytes", len(resp.content), stage="api", host=host)
+    return resp
+
+
+def setApiRate(rate, host=None):
+    """Change the API request rate of one host, or of every host.
+
+    Args:
+        rate (float): Requests per second
+        host (str, optional): Host name; all hosts if not given
+    """
+    global API_RATE
+    with _apiLimiterLock:
+        if host:
+            _apiLimiters[host] = RateLimiter(rate)
+        else:
+            API_RATE = rate
+            for known in _apiLimiters.keys():
+                _apiLimiters[known] = RateLimiter(rate)
+
+
+class DownloadEngine():
+    """Downloads batches of files concurrently, reporting to one byte progress bar.
+
+    Each host has its own request rate and connection cap, on top of a total cap
+    on concurrent downloads, so a slow or strict site doesn't hold back the others.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE):
+        """
+        Args:
+            workers (int, optional): Number of concurrent downloads, across all hosts
+            rate (float, optional): Requests per second for hosts without their own limit
+        """
+        self.workers = workers
+        self.rate = rate
+        self.slots = threading.BoundedSemaphore(workers)
+        self.hosts = {}  # host -> (RateLimiter, BoundedSemaphore)
+        self.hostLock = threading.Lock()
+        self.progressLock = threading.Lock()
+
+    def configure(self, workers=None, rate=None):
+        """Change the total worker count and/or the request rate, before any download starts.
+        A new worker count replaces every host's own connection cap, and a new rate every host's own rate.
+
+        Args:
+            workers (int, optional): Number of concurrent downloads, across all hosts
+            rate (float, optional): Requests per second, per host
+        """
+        if workers:
+            self.workers = workers
+            self.slots = threading.BoundedSemaphore(workers)
+        if rate:
+            self.rate = rate
+        if workers or rate:
+            with self.hostLock:
+                for (host, (limiter, slots)) in list(self.hosts.items()):
+                    self.hosts[host] = (
+                        RateLimiter(rate or limiter.rate, burst=workers or limiter.burst),
+                        threading.BoundedSemaphore(workers) if workers else slots
+                    )
+
+    def setHostLimits(self, host, rate=None, workers=None):
+        """Give a host its own request rate and connection cap.
+
+        Args:
+            host (str): Host name
+            rate (float, optional): Requests per second
+            workers (int, optional): Concurrent downloads from this host
+        """
+        workers = workers or self.workers
+        with self.hostLock:
+            self.hosts[host] = (RateLimiter(rate or self.rate, burst=workers), threading.BoundedSemaphore(workers))
+
+    def _hostLimits(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.hostLock:
+            limits = self.hosts.get(host)
+            if limits is None:
+                limits = self.hosts[host] = (
+                    RateLimiter(self.rate, burst=self.workers),
+                    threading.BoundedSemaphore(self.workers)
+                )
+            return limits
+
+    def download(self, jobs, desc=None):
+        """Download a batch of files, blocking until all are finished.
+        Batches may run in parallel; the worker counts cap downloads across all of them.
+
+        Files are written to a `.part` file next to the destination and only renamed into
+        place once complete and, if an md5 is given, verified. A `.part` file left by an
+        interrupted run is resumed with a Range request.
+
+        Args:
+            jobs (List): Tuples of (source url, destination path, expected size, base64 md5 or None)
+            desc (str, optional): Progress bar label
+
+        Returns:
+            List: The jobs that failed
+        """
+        failures = []
+        totalSize = sum(fsize for (src, dstpath, fsize, md5) in jobs if fsize)
+        progress = tqdm.tqdm(desc=desc, total=totalSize, unit='B', unit_scale=True)
+        try:
+            with loom.Spool(self.workers) as spool:
+                for (src, dstpath, fsize, md5) in jobs:
+                    spool.enqueue(target=self._fetch, args=(src, dstpath, fsize or 0, md5, progress, failures,))
+                spool.finish()
+        finally:
+            progress.close()
+        return failures
+
+    def _fetch(self, src, dstpath, fsize, md5, progress, failures):
+        """Worker: stream one file to disk, resuming and verifying it.
+        Errors are logged and added to `failures` rather than raised, so one failure doesn't stop the batch.
+        """
+        partpath = dstpath + ".part"
+        written = 0
+        received = 0
+        diskTime = 0
+        ok = False
+        error = None
+        host = urllib.parse.urlsplit(src).netloc
+        (limiter, hostSlots) = self._hostLimits(src)
+        # Host first, so waiting on a busy host doesn't hold up other hosts
+        start = time.monotonic()
+        hostSlots.acquire()
+        self.slots.acquire()
+        metrics.observe("slot_wait_seconds", time.monotonic() - start, stage="media", host=host)
+        try:
+            # Hash what an earlier attempt left, so verification still covers the whole file
+            digest = hashlib.md5()
+            try:
+                with open(partpath, "rb") as fp:
+                    for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                        written += len(chunk)
+            except FileNotFoundError:
+                pass
+            self._advance(progress, written)
+
+            start = time.monotonic()
+            limiter.wait()
+            metrics.observe("rate_limit_wait_seconds", time.monotonic() - start, stage="media", host=host)
+            start = time.monotonic()
+            session = getSession(src, self.workers)
+            headers = {"Range": "bytes={}-".format(written)} if written else {}
+            with session.get(src, stream=True, timeout=TIMEOUT, headers=headers) as resp:
+                if resp.status_code != 416:  # 416: The part file is already complete
+                    resp.raise_for_status()
+                    if written and resp.status_code != 206:
+                        # Server ignored the range; start over
+                        self._advance(progress, -written)
+                        written = 0
+                        digest = hashlib.md5()
+                    with open(partpath, "ab" if written else "wb") as fp:
+                        for chunk in resp.iter_content(CHUNK_SIZE):
+                            writeStart = time.monotonic()
+                            fp.write(chunk)
+                            diskTime += time.monotonic() - writeStart
+                            digest.update(chunk)
+                            written += len(chunk)
+                            received += len(chunk)
+                            self._advance(progress, len(chunk))
+
+            if md5 and base64.b64encode(digest.digest()).decode("ascii") != md5:
+                os.unlink(partpath)
+                raise IntegrityError("{} doesn't match md5 {}".format(src, md5))
+            os.replace(partpath, dstpath)
+            ok = True
+        except requests.exceptions.RequestException as e:
+            error = type(e).__name__
+            logger.error("Error downloading {}".format(src), exc_info=True)
+        except IntegrityError as e:
+            error = type(e).__name__
+            logger.error("Corrupt download discarded", exc_info=True)
+        except OSError as e:
+            error = type(e).__name__
+            logger.error("Error saving {}".format(dstpath), exc_info=True)
+        finally:
+            self.slots.release()
+            hostSlots.release()
+            metrics.observe("latency_seconds", time.monotonic() - start, stage="media", host=host)
+            metrics.observe("disk_write_seconds", diskTime, stage="media", host=host)
+            metrics.count("files", stage="media", host=host, result="ok" if ok else "failed")
+            metrics.count("bytes", received, stage="media", host=host)
+            if error:
+                metrics.count("errors", stage="media", host=host, error=error)
+            if not ok:
+                failures.append((src, dstpath, fsize, md5,))
+            # Keep the bar's total honest if we got more or less than expected
+            with self.progressLock:
+                progress.total += written - fsize
+                progress.refresh()
+
+    def _advance(self, progress, nbytes):
+        with self.progressLock:
+            progress.update(nbytes)
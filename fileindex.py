@@ -0,0 +1,133 @@
+import os
+import re
+import sqlite3
+import threading
+
+from snip.stream import TriadLogger
+logger = TriadLogger(__name__)
+
+# Matches the names made by getDestImagePath: {threadno}-{no}-{filename}{ext}
+# but not getDestImagePathLegacy3's {threadno}-{tim}-{filename}{ext}. A tim is a
+# 13 digit millisecond timestamp; post numbers are far shorter.
+SAVED_FILE_PATTERN = re.compile(r"^(\d+)-(\d{1,12})-")
+# Unfinished downloads and links
+TEMP_SUFFIXES = (".part", ".link",)
+
+
+class FileIndex():
+    """On-disk index of every saved media file, so skip checks don't touch the filesystem.
+
+    Rows are keyed by board and post number. Each board's rows are loaded into
+    memory the first time the board is queried; new rows are written to the
+    database in batches by `save`.
+    """
+
+    def __init__(self, dbpath="./saved/index.sqlite3"):
+        """
+        Args:
+            dbpath (str, optional): Database location
+        """
+        self.dbpath = dbpath
+        self.lock = threading.Lock()
+        self.boards = {}  # board -> {no: (path, size)}
+        self.pending = []
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.dbpath), exist_ok=True)
+            self._db = sqlite3.connect(self.dbpath, check_same_thread=False)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS files (
+                board TEXT NOT NULL,
+                no INTEGER NOT NULL,
+                tim INTEGER,
+                md5 TEXT,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (board, no)
+            )""")
+            # Nothing looks files up by md5
+            self._db.execute("DROP INDEX IF EXISTS files_md5")
+        return self._db
+
+    def _board(self, board):
+        # Caller holds the lock
+        rows = self.boards.get(board)
+        if rows is None:
+            rows = {
+                no: (path, size)
+                for (no, path, size) in self.db.execute("SELECT no, path, size FROM files WHERE board = ?", (board,))
+            }
+            self.boards[board] = rows
+        return rows
+
+    def has(self, board, no, path, size):
+        """Check whether a post's file is already saved, without touching the filesystem.
+
+        Args:
+            board (str): Board acronym
+            no (int): Post number
+            path (str): Where the file should be
+            size (int): Expected file size
+
+        Returns:
+            bool
+        """
+        with self.lock:
+            return self._board(board).get(no) == (path, size)
+
+    def add(self, board, post, path, size=None):
+        """Record a saved file. Written to disk on the next `save`.
+
+        Args:
+            board (str): Board acronym
+            post (Post): Post object, with a file
+            path (str): Where the file was saved
+            size (int, optional): File size, if not the post's fsize
+        """
+        size = size if size is not None else post.file.fsize
+        with self.lock:
+            self._board(board)[post.no] = (path, size)
+            self.pending.append((board, post.no, post.file.tim, post.file.md5, path, size))
+
+    def save(self):
+        """Write pending rows to the database."""
+        with self.lock:
+            if not self.pending:
+                return
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", self.pending)
+            self.pending = []
+
+    def reindex(self, root="./saved"):
+        """Rebuild the whole index from the files on disk.
+        Files that don't follow the current naming scheme are ignored.
+
+        Args:
+            root (str, optional): Saved media folder
+        """
+        rows = []
+        for board in sorted(os.listdir(root)):
+            boarddir = os.path.join(root, board)
+            if board.startswith(".") or not os.path.isdir(boarddir):
+                continue
+            logger.info("Indexing /{}/".format(board))
+            for semdir in os.scandir(boarddir):
+                if not semdir.is_dir():
+                    continue
+                dstdir = "{}/{}/{}/".format(root, board, semdir.name)
+                for entry in os.scandir(semdir.path):
+                    match = SAVED_FILE_PATTERN.match(entry.name)
+                    if not (match and entry.is_file()) or entry.name.endswith(TEMP_SUFFIXES):
+                        continue
+                    path = os.path.join(dstdir, entry.name)
+                    rows.append((board, int(match.group(2)), None, None, path, entry.stat().st_size))
+
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM files")
+                self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.boards = {}
+            self.pending = []
+        logger.info("Indexed {} files".format(len(rows)))
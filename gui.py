@@ -1,8 +1,17 @@
 import tkinter as tk
 from tkinter import ttk
-from snip import tkit
 
 import enum
+import queue
+import threading
+
+from snip.stream import TriadLogger
+logger = TriadLogger(__name__)
+
+# Rows are added this many at a time between redraws, so big catalogs don't freeze the window
+ROW_BATCH = 100
+POLL_MS = 50
+FILTER_DELAY_MS = 150
 
 
 class Result(enum.Enum):
@@ -12,12 +21,85 @@ class Result(enum.Enum):
     END = enum.auto()
 
 
+class Catalog():
+    """One board's rows, as loaded by the background loader."""
+
+    def __init__(self, board, rows, selectionNos):
+        """
+        Args:
+            board (str): Board acronym
+            rows (List): Tuples of (thread number, list of column strings)
+            selectionNos (Set): Thread numbers selected when the board was loaded
+        """
+        self.board = board
+        self.rows = rows
+        self.initial_selections = set(selectionNos)
+        self.selections = set(selectionNos)
+        # Lowercase text of each row, for filtering
+        self.text = {
+            no: " ".join(values).lower()
+            for (no, values) in rows
+        }
+
+
+class CatalogLoader(threading.Thread):
+    """Loads catalogs in board order, one board ahead of the board being shown."""
+
+    def __init__(self, boards, loadCatalog, results):
+        """
+        Args:
+            boards (List): Board acronyms, in the order they are shown
+            loadCatalog (function): board -> (rows, selected thread numbers). Called off the Tk thread.
+            results (queue.Queue): Receives a Catalog, or (board, exception), per board
+        """
+        super(CatalogLoader, self).__init__(name="CatalogLoader", daemon=True)
+        self.boards = boards
+        self.loadCatalog = loadCatalog
+        self.results = results
+        self.shown = 0
+        self.condition = threading.Condition()
+
+    def show(self, index):
+        """Let the loader prefetch the board after `index`."""
+        with self.condition:
+            self.shown = index
+            self.condition.notify()
+
+    def run(self):
+        for (index, board) in enumerate(self.boards):
+            with self.condition:
+                self.condition.wait_for(lambda: index <= self.shown + 1)
+            try:
+                (rows, selectionNos) = self.loadCatalog(board)
+                self.results.put(Catalog(board, rows, selectionNos))
+            except Exception as e:
+                logger.error("Error loading /{}/".format(board), exc_info=True)
+                self.results.put((board, e))
+
+
 class SelectorWindow(tk.Tk):
-    def __init__(self, title, headers, tablerows, selectionNos, saveCallback, *args, **kwargs):
+    """Thread selector for every board, in one window.
+
+    The window opens before any catalog is loaded. Catalogs are fetched in the
+    background, rows are added in batches as they arrive, and the filter box
+    hides rows in place instead of rebuilding the list.
+    """
+
+    def __init__(self, boards, headers, loadCatalog, saveCallback, *args, **kwargs):
+        """
+        Args:
+            boards (List): Board acronyms, in the order to show them
+            headers (List): Column names. Rows are keyed by thread number, not a column.
+            loadCatalog (function): board -> (rows, selected thread numbers), where rows are
+                tuples of (thread number, list of column strings). Runs in a background thread.
+            saveCallback (function): (board, set of selected thread numbers) -> None
+        """
         super(SelectorWindow, self).__init__(*args, **kwargs)
 
-        self.selections = None
-        self.initial_selections = selectionNos
+        self.boards = boards
+        self.boardIndex = 0
+        self.catalogs = {}
+        self.failures = {}
         self.RESULT = Result.RUNNING
 
         self.saveCallback = saveCallback
@@ -25,56 +107,119 @@ class SelectorWindow(tk.Tk):
         self.protocol("WM_DELETE_WINDOW", self.end(Result.ABORT))
         self.bind("<Escape>", self.end(Result.ABORT))
 
-        self.SelectorFrame = SelectorFrame(
-            self, 
-            title, 
-            headers, 
-            tablerows, 
-            selectionNos
-        )
+        self.SelectorFrame = SelectorFrame(self, headers)
         self.SelectorFrame.grid(sticky="nsew")
 
         self.columnconfigure(0, weight=1)
         self.rowconfigure(0, weight=1)
         self.geometry("950x800")
 
+        self.results = queue.Queue()
+        self.loader = CatalogLoader(boards, loadCatalog, self.results)
+        self.loader.start()
+
+        self.showBoard()
+        self.after(POLL_MS, self.pollResults)
         self.mainloop()
 
+    @property
+    def board(self):
+        return self.boards[self.boardIndex]
+
+    def pollResults(self):
+        try:
+            while True:
+                result = self.results.get_nowait()
+                if isinstance(result, Catalog):
+                    self.catalogs[result.board] = result
+                    board = result.board
+                else:
+                    (board, error) = result
+                    self.failures[board] = error
+                if board == self.board:
+                    self.showBoard()
+        except queue.Empty:
+            pass
+        if self.RESULT == Result.RUNNING:
+            self.after(POLL_MS, self.pollResults)
+
+    def showBoard(self):
+        self.loader.show(self.boardIndex)
+        title = "/{}/ threads ({} of {})".format(self.board, self.boardIndex + 1, len(self.boards))
+        if self.board in self.catalogs:
+            self.SelectorFrame.load(title, self.catalogs[self.board])
+        elif self.board in self.failures:
+            self.SelectorFrame.clear(title, "Couldn't load /{}/: {}".format(self.board, self.failures[self.board]))
+        else:
+            self.SelectorFrame.clear(title, "Loading /{}/...".format(self.board))
+
     def end(self, result, save=False):
         def _end(event=None):
             if save:
                 self.saveSelections()
+            if result == Result.NEXT and self.boardIndex + 1 < len(self.boards):
+                self.boardIndex += 1
+                self.showBoard()
+                return
             self.RESULT = result
             self.destroy()
         return _end
 
     def resetSelections(self, event=None):
-        self.SelectorFrame.listbox_threads.modSelection(self.initial_selections)
+        self.SelectorFrame.resetSelections()
 
     def saveSelections(self, event=None):
-        self.saveCallback(self.SelectorFrame.getSelections())
+        catalog = self.catalogs.get(self.board)
+        if catalog is not None:
+            self.saveCallback(catalog.board, set(catalog.selections))
 
 
 class SelectorFrame(tk.Frame):
 
     # Init and window management
-    def __init__(self, parent, title, headers, items, selectionNos, *args, **kwargs):
-
-        if "ID" not in headers:
-            raise AssertionError("SelectorFrame MUST have data field 'ID'!")
+    def __init__(self, parent, headers, *args, **kwargs):
 
         tk.Frame.__init__(self, parent, *args, **kwargs)
 
+        self.catalog = None
+        self.inserted = 0
+        self.visible = []
+        self.filterJob = None
+
         # Setup GUI parts
-        lab_title = lab_title = tk.Label(self, text=title, font=("Helvetica", 24))
+        lab_title = tk.Label(self, font=("Helvetica", 24))
         lab_title.grid(row=0, column=0, sticky="we")
 
-        listbox_threads = tkit.MultiColumnListbox(self, headers, items, multiselect=True, hscroll=True, nonestr="")
-        listbox_threads.grid(row=1, column=0, sticky="nsew", padx=(4, 18))
+        frame_filter = tk.Frame(self)
+        frame_filter.grid(row=1, column=0, sticky="we", padx=4)
+        frame_filter.grid_columnconfigure(1, weight=1)
+        tk.Label(frame_filter, text="Filter:").grid(row=0, column=0)
+        self.filterText = tk.StringVar(self)
+        self.filterText.trace_add("write", self.scheduleFilter)
+        entry_filter = ttk.Entry(frame_filter, textvariable=self.filterText)
+        entry_filter.grid(row=0, column=1, sticky="we")
+        lab_status = tk.Label(frame_filter, anchor="e")
+        lab_status.grid(row=0, column=2, sticky="e", padx=4)
+
+        frame_tree = tk.Frame(self)
+        frame_tree.grid(row=2, column=0, sticky="nsew", padx=(4, 18))
+        frame_tree.grid_columnconfigure(0, weight=1)
+        frame_tree.grid_rowconfigure(0, weight=1)
+        tree_threads = ttk.Treeview(frame_tree, columns=headers, show="headings", selectmode="none")
+        for header in headers:
+            tree_threads.heading(header, text=header)
+            tree_threads.column(header, width=120, stretch=True)
+        tree_threads.grid(row=0, column=0, sticky="nsew")
+        vscroll = ttk.Scrollbar(frame_tree, orient="vertical", command=tree_threads.yview)
+        vscroll.grid(row=0, column=1, sticky="ns")
+        hscroll = ttk.Scrollbar(frame_tree, orient="horizontal", command=tree_threads.xview)
+        hscroll.grid(row=1, column=0, sticky="we")
+        tree_threads.configure(yscrollcommand=vscroll.set, xscrollcommand=hscroll.set)
+        tree_threads.bind("<Button-1>", self.toggleRow)
 
         # Buttons, in a frame
         frame_buttons = tk.Frame(self)
-        frame_buttons.grid(row=2, column=0, sticky="sew")
+        frame_buttons.grid(row=3, column=0, sticky="sew")
 
         # Space buttons evenly
         frame_buttons.grid_columnconfigure(0, weight=1)
@@ -94,7 +239,7 @@ class SelectorFrame(tk.Frame):
             text="Save", command=parent.saveSelections).grid(
             row=0, column=1, sticky="sew", padx=4, pady=4)
         ttk.Button(
-            frame_buttons, 
+            frame_buttons,
             text="Reset", command=parent.resetSelections).grid(
             row=1, column=1, sticky="sew", padx=4, pady=4)
         ttk.Button(
@@ -107,16 +252,100 @@ class SelectorFrame(tk.Frame):
             row=1, column=2, sticky="sew", padx=4, pady=4)
 
         self.columnconfigure(0, weight=1)
-        self.rowconfigure(1, weight=1)
+        self.rowconfigure(2, weight=1)
 
         # Expose interfaces
-        self.listbox_threads = listbox_threads
+        self.lab_title = lab_title
+        self.lab_status = lab_status
+        self.tree_threads = tree_threads
+        entry_filter.focus_set()
+
+    def clear(self, title, status=""):
+        """Empty the list, i.e. while a board loads."""
+        if self.catalog is not None:
+            # Includes rows hidden by the filter
+            self.tree_threads.delete(*[str(no) for (no, values) in self.catalog.rows[:self.inserted]])
+        self.catalog = None
+        self.inserted = 0
+        self.visible = []
+        self.lab_title.configure(text=title)
+        self.lab_status.configure(text=status)
+
+    def load(self, title, catalog):
+        """Show a board's rows. Rows are inserted in batches between redraws.
+
+        Args:
+            title (str): Window heading
+            catalog (Catalog): The board's rows and selections
+        """
+        self.clear(title)
+        self.catalog = catalog
+        self.insertBatch(catalog)
+
+    def insertBatch(self, catalog):
+        # A newer board may have been loaded since this batch was scheduled
+        if catalog is not self.catalog:
+            return
+        for (no, values) in catalog.rows[self.inserted:self.inserted + ROW_BATCH]:
+            self.tree_threads.insert("", "end", iid=str(no), values=values)
+        self.inserted = min(self.inserted + ROW_BATCH, len(catalog.rows))
+        self.applyFilter()
+        if self.inserted < len(catalog.rows):
+            self.lab_status.configure(text="Loading {} of {}".format(self.inserted, len(catalog.rows)))
+            self.after(1, self.insertBatch, catalog)
+
+    def scheduleFilter(self, *args):
+        # Wait for a pause in typing before filtering
+        if self.filterJob is not None:
+            self.after_cancel(self.filterJob)
+        self.filterJob = self.after(FILTER_DELAY_MS, self.applyFilter)
+
+    def applyFilter(self):
+        """Show only rows containing every word in the filter box, in catalog order.
+        Hidden rows are detached, not deleted, and keep their selection."""
+        self.filterJob = None
+        if self.catalog is None:
+            return
+        terms = self.filterText.get().lower().split()
+        visible = [
+            str(no)
+            for (no, values) in self.catalog.rows[:self.inserted]
+            if all(term in self.catalog.text[no] for term in terms)
+        ]
+        attached = list(self.tree_threads.get_children())
+        if visible != attached:
+            self.tree_threads.detach(*attached)
+            for (index, iid) in enumerate(visible):
+                self.tree_threads.move(iid, "", index)
+        self.visible = visible
+        self.showSelections()
+        if self.inserted == len(self.catalog.rows):
+            self.lab_status.configure(text="{} of {} threads, {} selected".format(
+                len(visible), len(self.catalog.rows), len(self.catalog.selections)))
+
+    def showSelections(self):
+        self.tree_threads.selection_set([
+            iid for iid in self.visible
+            if int(iid) in self.catalog.selections
+        ])
 
-        # Load data
-        listbox_threads.modSelection(selectionNos)
+    def toggleRow(self, event):
+        iid = self.tree_threads.identify_row(event.y)
+        if not iid or self.catalog is None:
+            return
+        no = int(iid)
+        if no in self.catalog.selections:
+            self.catalog.selections.discard(no)
+        else:
+            self.catalog.selections.add(no)
+        self.showSelections()
+        self.lab_status.configure(text="{} of {} threads, {} selected".format(
+            len(self.visible), len(self.catalog.rows), len(self.catalog.selections)))
 
-        # for w in [self, lab_title, listbox_threads, frame_buttons, btn_cancel, btn_done]:
-        #     print(w, "in", w.master)
+    def resetSelections(self):
+        if self.catalog is not None:
+            self.catalog.selections = set(self.catalog.initial_selections)
+            self.showSelections()
 
     def getSelections(self):
-        return self.listbox_threads.getSelections()
+        return set(self.catalog.selections) if self.catalog else set()
@@ -0,0 +1,104 @@
+import threading
+
+from snip import jfileutil as ju
+from engine import apiGet
+
+from snip.stream import TriadLogger
+logger = TriadLogger(__name__)
+
+
+class ValidatorCache():
+    """Remembers Last-Modified/ETag validators per url, so unchanged resources come back as 304.
+
+    Validators are only recorded once the caller `commit`s a response, so a thread
+    that failed halfway through processing is fetched in full again next time.
+    """
+
+    def __init__(self, filename="httpCache"):
+        """
+        Args:
+            filename (str, optional): Name of the jobj file the validators persist to
+        """
+        self.filename = filename
+        self.validators = ju.json_load(filename, default={})
+        self.bodies = {}  # In-memory only: url -> last parsed json
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def fetch(self, url, conditional=True):
+        """GET an API url, sending any validators we have for it.
+
+        Args:
+            url (str): API url
+            conditional (bool, optional): Send validators
+
+        Returns:
+            requests.Response: Status 304 if the resource is unchanged
+        """
+        headers = {}
+        with self.lock:
+            validator = self.validators.get(url) if conditional else None
+        if validator:
+            if validator.get("etag"):
+                headers["If-None-Match"] = validator.get("etag")
+            if validator.get("last-modified"):
+                headers["If-Modified-Since"] = validator.get("last-modified")
+        return apiGet(url, headers=headers)
+
+    def fetchJson(self, url):
+        """GET and parse an API url, reusing the last parsed body on 304.
+        Only the body from this session can be reused, so the first fetch is unconditional.
+
+        Args:
+            url (str): API url
+
+        Returns:
+            Json object
+        """
+        with self.lock:
+            known = url in self.bodies
+        resp = self.fetch(url, conditional=known)
+        if resp.status_code == 304:
+            return self.bodies[url]
+        resp.raise_for_status()
+        body = resp.json()
+        with self.lock:
+            self.bodies[url] = body
+        self.commit(url, resp)
+        return body
+
+    def commit(self, url, resp):
+        """Record the validators of a response once it has been fully handled.
+
+        Args:
+            url (str): Url the response was fetched from
+            resp (requests.Response)
+        """
+        validator = {
+            "etag": resp.headers.get("ETag"),
+            "last-modified": resp.headers.get("Last-Modified")
+        }
+        if not any(validator.values()):
+            return
+        with self.lock:
+            self.validators[url] = validator
+            self.dirty = True
+
+    def forget(self, url):
+        """Drop everything known about a url, i.e. when it 404s.
+
+        Args:
+            url (str)
+        """
+        with self.lock:
+            self.bodies.pop(url, None)
+            if self.validators.pop(url, None):
+                self.dirty = True
+
+    def save(self):
+        """Write validators to disk, if they changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            ju.json_save(dict(self.validators), self.filename)
+            self.dirty = False
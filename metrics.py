@@ -0,0 +1,176 @@
+import contextlib
+import os
+import tempfile
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+
+def labelKey(labels):
+    return tuple(sorted((key, str(value)) for (key, value) in labels.items() if value is not None))
+
+
+class Histogram():
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for (i, bound) in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Returns:
+            float: Upper bound of the bucket the quantile falls in, or None if that is the unbounded bucket
+        """
+        rank = q * self.count
+        seen = 0
+        for (bound, count) in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound if bound != float("inf") else None
+        return None
+
+
+class Metrics():
+    """Counters and latency histograms for one run, shared by all threads.
+
+    Every metric is keyed by name and a set of labels, i.e.
+    `count("bytes", 1024, stage="media", host="i.4cdn.org")`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}  # (name, labels) -> number
+        self.histograms = {}  # (name, labels) -> Histogram
+
+    def count(self, name, value=1, **labels):
+        """Add to a counter.
+
+        Args:
+            name (str): Counter name
+            value (int, optional): Amount to add
+            **labels: Label values
+        """
+        key = (name, labelKey(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Record a duration.
+
+        Args:
+            name (str): Histogram name
+            seconds (float): Duration
+            **labels: Label values
+        """
+        key = (name, labelKey(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, stage, **labels):
+        """Time a with block as one operation of a stage.
+        Errors are counted by exception class, and raised again.
+
+        Args:
+            stage (str): Stage name, i.e. "thread_fetch"
+            **labels: Label values
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self.count("errors", stage=stage, error=type(e).__name__, **labels)
+            raise
+        finally:
+            self.observe("latency_seconds", time.monotonic() - start, stage=stage, **labels)
+
+    def summary(self):
+        """
+        Returns:
+            Dict: Json run summary
+        """
+        with self.lock:
+            return {
+                "started": self.started,
+                "duration": time.time() - self.started,
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for ((name, labels), value) in sorted(self.counters.items())
+                ],
+                "latency": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "mean": histogram.sum / histogram.count if histogram.count else None,
+                        "p50": histogram.quantile(0.5),
+                        "p90": histogram.quantile(0.9),
+                        "p99": histogram.quantile(0.99)
+                    }
+                    for ((name, labels), histogram) in sorted(self.histograms.items())
+                ]
+            }
+
+    def writePrometheus(self, path, prefix="fourchandl_"):
+        """Write every metric in the Prometheus text format, i.e. for node_exporter's textfile collector.
+        The file is replaced in one step, so a scrape never sees half of it.
+
+        Args:
+            path (str): File to write
+            prefix (str, optional): Prefix for metric names, which can't start with a digit
+        """
+        def formatLabels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(key, value.replace('"', '\\"')) for (key, value) in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            for name in sorted(set(name for (name, labels) in self.counters)):
+                lines.append("# TYPE {}{}_total counter".format(prefix, name))
+                for ((cname, labels), value) in sorted(self.counters.items()):
+                    if cname == name:
+                        lines.append("{}{}_total{} {}".format(prefix, name, formatLabels(labels), value))
+            for name in sorted(set(name for (name, labels) in self.histograms)):
+                lines.append("# TYPE {}{} histogram".format(prefix, name))
+                for ((hname, labels), histogram) in sorted(self.histograms.items()):
+                    if hname != name:
+                        continue
+                    cumulative = 0
+                    for (bound, count) in zip(LATENCY_BUCKETS, histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append("{}{}_bucket{} {}".format(prefix, name, formatLabels(labels, [("le", le)]), cumulative))
+                    lines.append("{}{}_sum{} {}".format(prefix, name, formatLabels(labels), histogram.sum))
+                    lines.append("{}{}_count{} {}".format(prefix, name, formatLabels(labels), histogram.count))
+
+        # Unique temp name, so concurrent writers never replace each other's file
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp", delete=False
+        ) as fp:
+            fp.write("\n".join(lines) + "\n")
+        # Temp files are private; the exporter may run as another user
+        os.chmod(fp.name, 0o644)
+        os.replace(fp.name, path)
+
+
+# Shared by every module of a run
+metrics = Metrics()
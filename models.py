@@ -0,0 +1,170 @@
+# Compact objects for boards, threads, posts and their files, built from API json.
+# Only the fields we use are kept, in __slots__, so the json can be dropped once parsed.
+# `fields` maps our field names to a site's own, where a backend's mappings say they differ.
+
+
+def field(obj, name, fields=None):
+    """
+    Args:
+        obj (Dict): Json object
+        name (str): Our name for the field
+        fields (Dict, optional): Backend field name mappings
+
+    Returns:
+        The field's value, or None
+    """
+    return obj.get(fields.get(name, name) if fields else name)
+
+
+class MediaFile():
+    __slots__ = ("tim", "filename", "ext", "fsize", "md5", "w", "h")
+
+    def __init__(self, tim, filename, ext, fsize=None, md5=None, w=None, h=None):
+        self.tim = tim
+        self.filename = filename
+        self.ext = ext
+        self.fsize = fsize
+        self.md5 = md5
+        self.w = w
+        self.h = h
+
+    @classmethod
+    def fromJson(cls, obj, fields=None):
+        """
+        Args:
+            obj (Dict): Post json object
+            fields (Dict, optional): Backend field name mappings
+
+        Returns:
+            MediaFile: The post's file, or None if it has none
+        """
+        if not field(obj, "ext", fields):
+            return None
+        return cls(*(
+            field(obj, name, fields)
+            for name in ("tim", "filename", "ext", "fsize", "md5", "w", "h")
+        ))
+
+
+class Post():
+    __slots__ = ("no", "time", "now", "name", "sub", "com", "file")
+
+    def __init__(self, no, time=None, now=None, name=None, sub=None, com=None, file=None):
+        self.no = no
+        self.time = time
+        self.now = now
+        self.name = name
+        self.sub = sub
+        self.com = com
+        self.file = file
+
+    @classmethod
+    def fromJson(cls, obj, fields=None):
+        """
+        Args:
+            obj (Dict): Post json object
+            fields (Dict, optional): Backend field name mappings
+
+        Returns:
+            Post
+        """
+        return cls(
+            *(field(obj, name, fields) for name in ("no", "time", "now", "name", "sub", "com")),
+            MediaFile.fromJson(obj, fields)
+        )
+
+
+class Thread():
+    """A thread, from either a catalog entry (OP only) or a full thread json (all posts)."""
+    __slots__ = ("board", "no", "semantic_url", "archived", "tag", "bumplimit", "replies", "images", "posts")
+
+    def __init__(self, board, no, semantic_url=None, archived=False, tag=None, bumplimit=False, replies=None, images=None, posts=None):
+        self.board = board
+        self.no = no
+        self.semantic_url = semantic_url
+        self.archived = archived
+        self.tag = tag
+        self.bumplimit = bumplimit
+        self.replies = replies
+        self.images = images
+        self.posts = posts or []
+
+    @classmethod
+    def fromJson(cls, board, posts, fields=None):
+        """
+        Args:
+            board (str): Board acronym
+            posts (List): Post json objects, OP first. A catalog entry is a list of one.
+            fields (Dict, optional): Backend field name mappings
+
+        Returns:
+            Thread
+        """
+        op = posts[0]
+        return cls(
+            board,
+            field(op, "no", fields),
+            field(op, "semantic_url", fields),
+            bool(field(op, "archived", fields)),
+            field(op, "tag", fields),
+            bool(field(op, "bumplimit", fields)),
+            field(op, "replies", fields),
+            field(op, "images", fields),
+            [Post.fromJson(post, fields) for post in posts]
+        )
+
+    @property
+    def op(self):
+        return self.posts[0]
+
+    # Catalog fields live on the OP
+    name = property(lambda self: self.op.name)
+    sub = property(lambda self: self.op.sub)
+    com = property(lambda self: self.op.com)
+    time = property(lambda self: self.op.time)
+    tim = property(lambda self: self.op.file.tim if self.op.file else None)
+
+    def toJson(self):
+        """Summary form, as stored in the download queue.
+
+        Returns:
+            Dict: Thread json object
+        """
+        obj = {
+            "no": self.no,
+            "name": self.name,
+            "sub": self.sub,
+            "com": self.com,
+            "tim": self.tim,
+            "time": self.time,
+            "archived": 1 if self.archived else None,
+            "semantic_url": self.semantic_url,
+            "tag": self.tag,
+            "bumplimit": 1 if self.bumplimit else None
+        }
+        return {key: value for (key, value) in obj.items() if value is not None}
+
+
+class Board():
+    __slots__ = ("name", "threads")
+
+    def __init__(self, name, threads=None):
+        self.name = name
+        self.threads = threads or []
+
+    @classmethod
+    def fromCatalog(cls, name, catalog, fields=None):
+        """
+        Args:
+            name (str): Board acronym
+            catalog (List): Catalog json, a list of pages
+            fields (Dict, optional): Backend field name mappings
+
+        Returns:
+            Board
+        """
+        return cls(name, [
+            Thread.fromJson(name, [thread], fields)
+            for page in catalog
+            for thread in page.get("threads")
+        ])
@@ -0,0 +1,89 @@
+import os
+import snip.filesystem
+
+# Where saved files and text logs live
+
+
+def getMessageLogPath(board, sem, threadno):
+    """Generates the path of a thread's text log, without extension
+
+    Returns:
+        Tuple (directory, path)
+    """
+    msgBase = "./text/{}/".format(board)
+    return (msgBase, "{}{s}_{n}".format(msgBase, s=sem, n=threadno))
+
+
+def getDestImagePath(board, sem, post, threadno):
+    """Generates paths for saving images
+
+    Returns:
+        Tuple (directory, file, path)
+    """
+    dstdir = "./saved/{}/{}/".format(board, sem)
+    dstfile = snip.filesystem.easySlug("{}-{}-{}{}".format(
+        threadno,
+        post.no, 
+        post.file.filename, 
+        post.file.ext
+    ))
+    dstpath = os.path.join(dstdir, dstfile)
+    return (dstdir, dstfile, dstpath)
+
+
+def getDestImagePathLegacy3(board, sem, post, threadno):
+    """Generates paths for saving images
+
+    Returns:
+        Tuple (directory, file, path)
+    """
+    dstdir = "./saved/{}/{}/".format(board, sem)
+    if post.file.tim != post.file.filename:
+        dstfile = snip.filesystem.easySlug("{}-{}-{}{}".format(
+            threadno,
+            post.file.tim, 
+            post.file.filename, 
+            post.file.ext
+        ))
+    else:
+        dstfile = snip.filesystem.easySlug("{}{}".format(
+            post.file.tim, 
+            post.file.ext
+        ))
+    dstpath = os.path.join(dstdir, dstfile)
+    return (dstdir, dstfile, dstpath)
+
+
+def getDestImagePathLegacy(board, sem, post):
+    """Generates paths for saving images
+
+    Returns:
+        Tuple (directory, file, path)
+    """
+    dstdir = "./saved/{}/{}/".format(board, sem)
+    dstfile = "{}{}".format(post.file.tim, post.file.ext)
+    dstpath = os.path.join(dstdir, dstfile)
+    # logger.info(dstdir, dstfile, dstpath)
+    return (dstdir, dstfile, dstpath)
+
+
+def getDestImagePathLegacy2(board, sem, post):
+    """Generates paths for saving images
+
+    Returns:
+        Tuple (directory, file, path)
+    """
+    dstdir = "./saved/{}/{}/".format(board, sem)
+    if post.file.tim != post.file.filename:
+        dstfile = snip.filesystem.easySlug("{}-{}{}".format(
+            post.file.tim, 
+            post.file.filename, 
+            post.file.ext
+        ))
+    else:
+        dstfile = snip.filesystem.easySlug("{}{}".format(
+            post.file.tim, 
+            post.file.ext
+        ))
+    dstpath = os.path.join(dstdir, dstfile)
+    return (dstdir, dstfile, dstpath)
@@ -0,0 +1,86 @@
+import queue
+import threading
+import tqdm
+
+from snip import loom
+
+from snip.stream import TriadLogger
+logger = TriadLogger(__name__)
+
+
+class DownloadPipeline():
+    """Downloads boards in the background as their selections are saved.
+
+    Boards are submitted while the user is still selecting, and run in a worker
+    pool as soon as a worker is free. A board submitted again before it starts
+    only runs once; one submitted while running runs again afterwards, never
+    alongside itself. All boards share one progress bar.
+    """
+
+    def __init__(self, target, workers):
+        """
+        Args:
+            target (function): (board, progress) -> None. Downloads a board's queue,
+                adding its threads to the progress bar's total and advancing it per thread.
+            workers (int): Number of boards to download at once
+        """
+        self.target = target
+        self.workers = workers
+        self.boards = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.submitted = set()
+        self.boardLocks = {}
+        self.progress = None
+        self.thread = None
+
+    def start(self):
+        self.progress = tqdm.tqdm(total=0, unit="thread", desc="Downloading")
+        self.thread = threading.Thread(target=self.run, name="DownloadPipeline", daemon=True)
+        self.thread.start()
+
+    def submit(self, board):
+        """Queue a board for download.
+
+        Args:
+            board (str): Board acronym
+        """
+        with self.lock:
+            self.submitted.add(board)
+            if board in self.pending:
+                return
+            self.pending.add(board)
+            boardLock = self.boardLocks.setdefault(board, threading.Lock())
+        self.boards.put((board, boardLock))
+
+    def run(self):
+        with loom.Spool(self.workers) as spool:
+            while True:
+                job = self.boards.get()
+                if job is None:
+                    break
+                spool.enqueue(name=job[0], target=self.runBoard, args=job)
+            spool.finish()
+
+    def runBoard(self, board, boardLock):
+        with boardLock:
+            # From here on, submitting the board again schedules another run
+            with self.lock:
+                self.pending.discard(board)
+            try:
+                self.target(board, self.progress)
+            except Exception:
+                logger.error("Error downloading /{}/".format(board), exc_info=True)
+
+    def finish(self, boards=()):
+        """Wait for every submitted board to finish downloading.
+
+        Args:
+            boards (Iterable, optional): Boards to download too, if they weren't submitted
+        """
+        for board in boards:
+            if board not in self.submitted:
+                self.submit(board)
+        self.boards.put(None)
+        self.thread.join()
+        self.progress.close()
@@ -0,0 +1,86 @@
+import contextlib
+import heapq
+import itertools
+import threading
+
+# Priorities are tuples; the smallest goes first.
+# Threads are ranked by how soon they are likely to 404:
+#   1. Live threads before archived ones, which stay readable in the archive for days
+#   2. Fewer catalog pages left before the thread falls off the board
+#   3. Threads past the bump limit, which can only sink, before ones that can still be bumped
+#   4. Least recent activity first
+LOWEST_PRIORITY = (2, 0, 0, 0)
+
+
+def threadPriority(thread, lastModified=None, pagesLeft=None, archived=False):
+    """
+    Args:
+        thread (Dict): Queued thread json object
+        lastModified (int, optional): The thread's last_modified, from the board's thread list
+        pagesLeft (int, optional): Catalog pages below the thread's page; None if unknown
+        archived (bool, optional): Thread is in the board's archive
+
+    Returns:
+        Tuple: Sort key, most at risk first
+    """
+    return (
+        1 if archived or thread.get("archived") else 0,
+        pagesLeft or 0,
+        0 if thread.get("bumplimit") else 1,
+        lastModified or thread.get("time") or 0
+    )
+
+
+def mediaPriority(post):
+    """Smaller and older files first, so as many files as possible are saved before a thread dies.
+
+    Args:
+        post (Post): Post with a file
+
+    Returns:
+        Tuple: Sort key
+    """
+    return (post.file.fsize or 0, post.no)
+
+
+class PrioritySlots():
+    """A counting semaphore that lets the highest priority waiter in first.
+    Waiters of the same priority go in the order they arrived."""
+
+    def __init__(self, slots):
+        """
+        Args:
+            slots (int): Number of holders at once
+        """
+        self.free = slots
+        self.waiting = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+
+    def acquire(self, priority=LOWEST_PRIORITY):
+        with self.condition:
+            entry = (priority, next(self.order))
+            heapq.heappush(self.waiting, entry)
+            self.condition.wait_for(lambda: self.free > 0 and self.waiting[0] == entry)
+            heapq.heappop(self.waiting)
+            self.free -= 1
+            # The next waiter may be able to go too
+            self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.free += 1
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, priority=LOWEST_PRIORITY):
+        """Hold a slot for the duration of a with block.
+
+        Args:
+            priority (Tuple, optional): Sort key; smallest first
+        """
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,172 @@
+import json
+import os
+import tempfile
+import threading
+
+# The queue is read and written here rather than through jfileutil, so it can be
+# replaced atomically; it stays at the path jfileutil would use for the name
+JOBJ_DIR = "jobj"
+
+
+def jobjPath(name):
+    """
+    Args:
+        name (str): Name of a jobj file
+
+    Returns:
+        str: Its path
+    """
+    return os.path.join(JOBJ_DIR, name + ".json")
+
+
+def loadQueue(path):
+    try:
+        with open(path, "r", encoding="utf-8") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+
+def saveQueue(queue, path):
+    """Write the queue to a temp file next to `path`, then replace `path` with it in one step."""
+    folder = os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=folder, prefix=os.path.basename(path) + ".", suffix=".tmp", delete=False
+    ) as fp:
+        json.dump(queue, fp)
+    os.replace(fp.name, path)
+
+
+def setThreads(queue, board, threads):
+    queue[board] = list(threads)
+    return True
+
+
+def addThreads(queue, board, threads):
+    queued = queue.setdefault(board, [])
+    queuedNos = set(thread.get("no") for thread in queued)
+    new = []
+    for thread in threads:
+        if thread.get("no") not in queuedNos:
+            queuedNos.add(thread.get("no"))
+            new.append(thread)
+    queued.extend(new)
+    return len(new)
+
+
+def removeThreads(queue, board, threadnos):
+    threads = queue.get(board) or []
+    kept = [thread for thread in threads if thread.get("no") not in threadnos]
+    if len(kept) == len(threads):
+        return False
+    queue[board] = kept
+    return True
+
+
+class QueueStore():
+    """In-memory download queue, shared by all workers and persisted in batches.
+
+    The queue is the same `{board: [thread json, ...]}` object as the downloadQueue
+    jobj file, so selections made in another process are still picked up by `reload`.
+    Changes only touch memory, and are remembered until `save`, which applies them
+    over a fresh copy of the file and replaces it in one step. That way a save
+    keeps what other processes wrote since this one last read the file.
+    """
+
+    def __init__(self, filename="downloadQueue"):
+        """
+        Args:
+            filename (str, optional): Name of the jobj file the queue persists to
+        """
+        self.filename = filename
+        self.path = jobjPath(filename)
+        self.lock = threading.Lock()
+        self.queue = loadQueue(self.path)
+        self.changes = []  # (function, board, argument), in the order they were made
+
+    def change(self, function, board, argument):
+        with self.lock:
+            result = function(self.queue, board, argument)
+            if result:
+                self.changes.append((function, board, argument))
+            return result
+
+    def boards(self):
+        """
+        Returns:
+            List: Board acronyms with a queue
+        """
+        with self.lock:
+            return list(self.queue.keys())
+
+    def get(self, board):
+        """
+        Args:
+            board (str): Board acronym
+
+        Returns:
+            List: A copy of the board's queued thread json objects
+        """
+        with self.lock:
+            return list(self.queue.get(board) or [])
+
+    def threadnos(self):
+        """
+        Returns:
+            Set: (board, thread number) of every queued thread
+        """
+        with self.lock:
+            return set(
+                (board, thread.get("no"))
+                for (board, threads) in self.queue.items()
+                for thread in threads
+            )
+
+    def set(self, board, threads):
+        """Replace a board's queue, i.e. with a new selection.
+
+        Args:
+            board (str): Board acronym
+            threads (List): Thread json objects
+        """
+        self.change(setThreads, board, list(threads))
+
+    def add(self, board, threads):
+        """Queue threads on a board, keeping what is already queued.
+
+        Args:
+            board (str): Board acronym
+            threads (List): Thread json objects
+
+        Returns:
+            int: Number of threads that weren't queued yet
+        """
+        return self.change(addThreads, board, list(threads))
+
+    def remove(self, board, threadnos):
+        """Drop threads from a board's queue.
+
+        Args:
+            board (str): Board acronym
+            threadnos (Iterable): Thread numerical ids
+        """
+        self.change(removeThreads, board, set(threadnos))
+
+    def save(self):
+        """Write the queue to disk, if it changed, keeping changes other processes saved meanwhile."""
+        with self.lock:
+            if not self.changes:
+                return
+            queue = loadQueue(self.path)
+            for (function, board, argument) in self.changes:
+                function(queue, board, argument)
+            saveQueue(queue, self.path)
+            self.queue = queue
+            self.changes = []
+
+    def reload(self):
+        """Pick up changes written by other processes. Unsaved changes are saved first."""
+        self.save()
+        with self.lock:
+            self.queue = loadQueue(self.path)
@@ -1,40 +1,349 @@
 #!/bin/python3
-from distutils.dir_util import copy_tree
 from glob import glob
-from os.path import abspath, normpath, dirname, split, join, getmtime
+from os.path import abspath, normpath, dirname, split, join
 from send2trash import send2trash
 # from time import sleep
+import errno
+import json
 import os
+import re
+import shutil
+import threading
 # from traceback import print_exc
 import datetime
+from snip import jfileutil as ju
 from snip import loom
 
 import prompt_toolkit as ptk
 
+COPY_BUFFER = 1024 * 1024
 
-def renameDir(src, dst):
+
+class MoveStatus():
+    """What each running move is doing, for the toolbar."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def set(self, name, text):
+        with self.lock:
+            self.jobs[name] = text
+
+    def done(self, name):
+        with self.lock:
+            self.jobs.pop(name, None)
+
+    def __str__(self):
+        with self.lock:
+            return " | ".join("{}: {}".format(name, text) for (name, text) in self.jobs.items())
+
+
+def treeSize(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        treeSize(entry.path) if entry.is_dir(follow_symlinks=False) else entry.stat(follow_symlinks=False).st_size
+        for entry in os.scandir(path)
+    )
+
+
+def copyTree(src, dst, progress):
+    """Stream a file or folder to a path that doesn't exist yet.
+
+    Args:
+        src (str): File or folder
+        dst (str): New path
+        progress (function): Called with the number of bytes in each chunk copied
+    """
+    def copyFile(srcfile, dstfile):
+        with open(srcfile, "rb") as fsrc, open(dstfile, "wb") as fdst:
+            while True:
+                chunk = fsrc.read(COPY_BUFFER)
+                if not chunk:
+                    break
+                fdst.write(chunk)
+                progress(len(chunk))
+        shutil.copystat(srcfile, dstfile)
+
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=copyFile)
+    else:
+        copyFile(src, dst)
+
+
+def moveTree(src, dst, progress):
+    """Move a file or folder, merging folders into ones that already exist.
+    Moves within a device are renames; only moves across devices copy data.
+    A file that already exists at the destination with the same size is a
+    duplicate, and is trashed; one with a different size is left where it is.
+
+    Args:
+        src (str): File or folder
+        dst (str): New path
+        progress (function): Called with the number of bytes in each chunk copied across devices
+
+    Returns:
+        List: Paths left in place because they conflict with the destination
+    """
+    # A trailing separator would make dirname() the destination itself
+    (src, dst) = (normpath(src), normpath(dst))
+    if not os.path.lexists(dst):
+        os.makedirs(dirname(dst), exist_ok=True)
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            copyTree(src, dst, progress)
+            send2trash(src)
+        return []
+
+    if os.path.isdir(src) and os.path.isdir(dst):
+        conflicts = []
+        for entry in list(os.scandir(src)):
+            conflicts += moveTree(entry.path, join(dst, entry.name), progress)
+        if not conflicts:
+            os.rmdir(src)
+        return conflicts
+
+    if os.path.isfile(src) and os.path.isfile(dst) and os.path.getsize(src) == os.path.getsize(dst):
+        send2trash(src)
+        return []
+    return [src]
+
+
+def renameDir(src, dst, status=None, name=None):
+    """Move a folder, reporting progress under `name` in `status`.
+
+    Args:
+        src (str): Folder
+        dst (str): New path
+        status (MoveStatus, optional): Shared job status
+        name (str, optional): Job name
+    """
     # jobstr = "{} -> {}".format(src, dst)
     if abspath(dst.lower()) == abspath(src.lower()):
         # print("Same folder.")
         return
+    status = status or MoveStatus()
+    name = name or dst
+    total = None
+    copied = 0
+
+    def progress(nbytes):
+        nonlocal total, copied
+        if total is None:
+            total = treeSize(src) or 1
+        copied += nbytes
+        status.set(name, "copying {:.0%}".format(copied / total))
+
     try:
-        copy_tree(src, dst)
-        send2trash(src)
+        status.set(name, "moving")
+        conflicts = moveTree(src, dst, progress)
+        if conflicts:
+            print("{}: left {} conflicting files in place".format(src, len(conflicts)))
         # print(jobstr)
         return
     except Exception as e:
         print(e)
         raise
+    finally:
+        status.done(name)
+
+
+class FolderStats():
+    __slots__ = ("mtime", "filecount", "size")
+
+    def __init__(self, mtime, filecount, size):
+        self.mtime = mtime
+        self.filecount = filecount
+        self.size = size
+
+
+def folderStats(path, withSize=False):
+    """Stat a folder in one pass of os.scandir, and everything in it if its size is wanted.
+
+    Args:
+        path (str): Folder
+        withSize (bool, optional): Walk the whole tree to total its size
+
+    Returns:
+        FolderStats: Modification time, number of visible entries directly inside,
+            and total size in bytes, or None without `withSize`
+    """
+    filecount = 0
+    size = 0 if withSize else None
+    stack = [path]
+    while stack:
+        folder = stack.pop()
+        for entry in os.scandir(folder):
+            if folder == path and not entry.name.startswith("."):
+                filecount += 1
+            if not withSize:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+    return FolderStats(os.stat(path).st_mtime, filecount, size)
+
+
+def scanFolders(paths, workers=6, withSize=False):
+    """Collect FolderStats for many folders, scanning each top level folder in parallel.
+
+    Args:
+        paths (List): Folders
+        workers (int, optional): Number of top level folders to scan at once
+        withSize (bool, optional): Total each folder's size, which walks its whole tree
+
+    Returns:
+        Dict: Path -> FolderStats. Folders that can't be scanned are reported and left out.
+    """
+    groups = {}
+    for path in paths:
+        groups.setdefault(dirname(normpath(path)), []).append(path)
+
+    stats = {}
+    lock = threading.Lock()
+
+    def scanGroup(group):
+        groupStats = {}
+        for path in group:
+            try:
+                groupStats[path] = folderStats(path, withSize)
+            except OSError as e:
+                print("Can't scan {}: {}".format(path, e))
+        with lock:
+            stats.update(groupStats)
+
+    with loom.Spool(workers) as spool:
+        for (parent, group) in groups.items():
+            spool.enqueue(name=parent, target=scanGroup, args=(group,))
+        spool.finish()
+    return stats
 
 
 sortmethods = {
-    "modtime": lambda g, r: sorted(g, key=getmtime, reverse=r),
-    "length": lambda g, r: sorted(g, key=len, reverse=r),
-    "filecount": lambda g, r: sorted(g, key=lambda x: len(glob(join(x, "*"))), reverse=r),
-    "alpha": lambda g, r: sorted(g, reverse=r)
+    "modtime": lambda g, r, s: sorted(g, key=lambda x: s[x].mtime, reverse=r),
+    "length": lambda g, r, s: sorted(g, key=len, reverse=r),
+    "filecount": lambda g, r, s: sorted(g, key=lambda x: s[x].filecount, reverse=r),
+    "size": lambda g, r, s: sorted(g, key=lambda x: s[x].size, reverse=r),
+    "alpha": lambda g, r, s: sorted(g, reverse=r)
 }
 
 
+class Rule():
+    """A batch rename rule, from a rules file.
+
+    Rules are json objects with a "dest" path template and any of:
+    "pattern", a regular expression searched in the folder name;
+    "board", the name of the folder's parent; and "after" and "before",
+    ISO dates bounding the folder's modification date. The template
+    takes {name}, {board}, {date}, {year}, {month} and the pattern's named groups.
+    """
+
+    def __init__(self, obj):
+        self.dest = obj["dest"]
+        self.pattern = re.compile(obj["pattern"], re.IGNORECASE) if obj.get("pattern") else None
+        self.board = obj.get("board")
+        self.after = datetime.date.fromisoformat(obj["after"]) if obj.get("after") else None
+        self.before = datetime.date.fromisoformat(obj["before"]) if obj.get("before") else None
+
+    def apply(self, path, mtime):
+        """
+        Args:
+            path (str): Source folder
+            mtime (float): The folder's modification time
+
+        Returns:
+            str: New path, relative to the destination folder, or None if the rule doesn't match
+        """
+        (parent, name) = split(normpath(path))
+        board = split(parent)[1]
+        date = datetime.date.fromtimestamp(mtime)
+        if self.board and board != self.board:
+            return None
+        if (self.after and date < self.after) or (self.before and date >= self.before):
+            return None
+        match = self.pattern.search(name) if self.pattern else None
+        if self.pattern and not match:
+            return None
+        fields = dict(match.groupdict() if match else {})
+        fields.update(name=name, board=board, date=date.isoformat(), year=date.year, month="{:02}".format(date.month))
+        return self.dest.format(**fields)
+
+
+def planFromRules(rulesfile, globbed, stats):
+    """
+    Args:
+        rulesfile (str): Json file holding a list of rules
+        globbed (List): Source folders, in order
+        stats (Dict): Path -> FolderStats
+
+    Returns:
+        List: Tuples of (source folder, new path relative to the destination folder).
+        Folders no rule matches are left out; the first matching rule wins.
+    """
+    with open(rulesfile, "r", encoding="utf-8") as fp:
+        rules = [Rule(obj) for obj in json.load(fp)]
+    plan = []
+    for path in globbed:
+        for rule in rules:
+            ans = rule.apply(path, stats[path].mtime)
+            if ans:
+                plan.append((path, ans,))
+                break
+    return plan
+
+
+def planFromMap(mapfile):
+    """
+    Args:
+        mapfile (str): Json file holding an object of source folder -> new path,
+            relative to the destination folder as in the prompt
+
+    Returns:
+        List: Tuples of (source folder, new path)
+    """
+    with open(mapfile, "r", encoding="utf-8") as fp:
+        mapping = json.load(fp)
+    plan = []
+    for (path, ans) in mapping.items():
+        if not os.path.isdir(path):
+            print("No such folder:", path)
+            continue
+        plan.append((path, ans,))
+    return plan
+
+
+def runPlan(plan, getdestfldr, mock=False):
+    """Print a batch plan and carry it out in the worker pool.
+
+    Args:
+        plan (List): Tuples of (source folder, new path relative to the destination folder)
+        getdestfldr (function): Source folder -> destination folder; the folder's parent without --destfldr
+        mock (bool, optional): Only print the plan
+    """
+    jobs = []
+    for (path, ans) in plan:
+        path = normpath(path)
+        newDir = normpath(join(getdestfldr(path), ans))
+        if abspath(newDir.lower()) == abspath(path.lower()):
+            continue
+        print("{} -> {}".format(path, newDir))
+        jobs.append((path, newDir, ans,))
+    print("{} of {} folders to move".format(len(jobs), len(plan)))
+    if mock:
+        return
+
+    status = MoveStatus()
+    with loom.Spool(6) as spool:
+        for (path, newDir, ans) in jobs:
+            spool.enqueue(name=ans, target=renameDir, args=(path, newDir, status, ans,))
+        spool.finish()
+
+
 def getArgs():
     import argparse
     ap = argparse.ArgumentParser()
@@ -51,15 +360,72 @@ def getArgs():
                     help="Reverse sort")
     ap.add_argument("--use-completer", action="store_true",
                     help="Use path completer")
+    ap.add_argument("--map", default=None,
+                    help="Don't prompt; move folders as listed in this json file of source folder -> new path")
+    ap.add_argument("--rules", default=None,
+                    help="Don't prompt; move globbed folders by the rules in this json file. "
+                    "With --mock, only print the plan")
     return ap.parse_args()
 
 
+class DirCache():
+    """Every folder under a root, kept in a jobj file between runs.
+
+    Each folder's subfolder names are stored with its mtime. A folder's mtime
+    changes when entries are added or removed, so on refresh only folders whose
+    mtime moved are listed again; the rest cost one stat.
+    """
+
+    def __init__(self, root, filename="completerCache"):
+        """
+        Args:
+            root (str): Folder to cache
+            filename (str, optional): Name of the jobj file, shared by all roots
+        """
+        self.root = root
+        self.filename = filename
+        self.caches = ju.json_load(filename, default={})
+        self.folders = self.caches.get(abspath(root), {})
+
+    def refresh(self):
+        """Bring the cache up to date with the disk and save it.
+
+        Returns:
+            List: Paths of every folder, relative to the root
+        """
+        folders = {}
+        stack = [""]
+        while stack:
+            relpath = stack.pop()
+            try:
+                mtime = os.stat(join(self.root, relpath)).st_mtime
+            except OSError:
+                continue
+            (cachedMtime, children) = self.folders.get(relpath, (None, None))
+            if cachedMtime != mtime:
+                try:
+                    children = [
+                        entry.name
+                        for entry in os.scandir(join(self.root, relpath))
+                        if entry.is_dir(follow_symlinks=False)
+                    ]
+                except OSError:
+                    continue
+            folders[relpath] = [mtime, children]
+            stack += [join(relpath, child) for child in children]
+
+        if folders != self.folders:
+            self.folders = folders
+            self.caches[abspath(self.root)] = folders
+            ju.json_save(self.caches, self.filename)
+        return list(folders.keys())
+
+
 def PathCompleter(destfldr):
-    globstr = join(destfldr, "**", "")
-    print("Scanning paths in", globstr)
+    print("Scanning paths in", destfldr)
     paths = [
-        root.replace(destfldr, "").replace("\\", "/") + "/"
-        for root, dirs, files in os.walk(destfldr)
+        (relpath.replace("\\", "/") + "/" if relpath else "/")
+        for relpath in DirCache(destfldr).refresh()
     ]
     paths = [p[1:] if p.startswith("/") else p for p in paths]
 
@@ -85,23 +451,37 @@ def main():
     print("Source:", srcdir)
     print("Dest:", getdestfldr("$src/"))
 
-    path_completer = PathCompleter(getdestfldr("$src/")) if args.use_completer else None
+    if args.map:
+        runPlan(planFromMap(args.map), getdestfldr, mock=args.mock)
+        return 0
+
+    path_completer = PathCompleter(getdestfldr("$src/")) if args.use_completer and not args.rules else None
 
     globbed = glob(srcdir)
-    try:
-        globbed = sortmethods[args.sort](globbed, args.reverse)
-        # print(globbed)
-    except KeyError:
+    print("Scanning", len(globbed), "folders")
+    # Only sorting by size needs more than the top level of each folder
+    stats = scanFolders(globbed, withSize=(args.sort == "size"))
+    # Folders that vanished or can't be read are skipped
+    globbed = [path for path in globbed if path in stats]
+    if args.sort in sortmethods:
+        globbed = sortmethods[args.sort](globbed, args.reverse, stats)
+    else:
         print("No such method as", args.sort)
         print("Valid methods include", sortmethods.keys())
+
+    if args.rules:
+        runPlan(planFromRules(args.rules, globbed, stats), getdestfldr, mock=args.mock)
+        return 0
+
+    status = MoveStatus()
     with loom.Spool(6) as spool:
         for path in globbed:
 
-            print(datetime.datetime.fromtimestamp(getmtime(path)).strftime("%Y-%m-%d"), normpath(path))
+            print(datetime.datetime.fromtimestamp(stats[path].mtime).strftime("%Y-%m-%d"), normpath(path))
             try:
                 ans = ptk.prompt(
                     "New path? > ", 
-                    bottom_toolbar=lambda: str(spool), reserve_space_for_menu=20,
+                    bottom_toolbar=lambda: "{} {}".format(spool, status), reserve_space_for_menu=20,
                     completer=path_completer, complete_in_thread=True)
             except EOFError:
                 ans = '\x04'
@@ -118,7 +498,7 @@ def main():
                 newDir = join(getdestfldr(path), ans)
                 print("{} -> {}".format(path, newDir))
                 if not args.mock:
-                    spool.enqueue(name=ans, target=renameDir, args=(path, newDir,))
+                    spool.enqueue(name=ans, target=renameDir, args=(path, newDir, status, ans,))
             except ValueError:
                 print("Invalid input. ")
 
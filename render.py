@@ -0,0 +1,130 @@
+import html
+import os
+import sqlite3
+import string
+import urllib.parse
+
+from concurrent.futures import ProcessPoolExecutor
+
+from archive import ThreadArchive
+from models import Thread
+from paths import getDestImagePath
+from paths import getMessageLogPath
+
+from snip.stream import TriadLogger
+logger = TriadLogger(__name__)
+
+RENDER_BUFFER = 256 * 1024
+
+HEADER = '\
+<link rel="stylesheet" type="text/css" href="4chan.css" />\n\
+<link rel="stylesheet" type="text/css" href="../4chan.css" />\n'
+
+POST_TEMPLATE = string.Template("\
+<div class='post'>\
+<span class='subline' id='p$no'>>$subline >>$no</span>\n \
+<span class='file'>File: $file</span>\n\
+$com</div>")
+
+FILE_TEMPLATE = string.Template("<a href='$href'>$name</a>")
+
+COMMENT_TEMPLATE = string.Template("\n<p class='comment'>$com</p>")
+
+
+def escape(value):
+    """Escape text for html. API text may already contain entities, so those are decoded first.
+
+    Args:
+        value: Any value
+
+    Returns:
+        str
+    """
+    return html.escape(html.unescape(str(value)))
+
+
+def renderPost(thread, post, logdir):
+    """Converts a post to an HTML fragment, linking its file to where it is saved
+
+    Args:
+        thread (Thread): Thread the post is in
+        post (Post): Post object
+        logdir (str): Directory of the log, which links are relative to
+
+    Returns:
+        str: HTML representation of post
+    """
+    subfields = [post.sub, post.name, post.now, post.no]
+    if post.file and post.file.filename:
+        (__, __, dstpath) = getDestImagePath(thread.board, thread.semantic_url, post, thread.no)
+        relpath = os.path.relpath(dstpath, logdir).replace(os.sep, "/")
+        file = FILE_TEMPLATE.substitute(
+            href=urllib.parse.quote(relpath),
+            name=escape(post.file.filename + post.file.ext)
+        )
+    else:
+        file = "None"
+    return POST_TEMPLATE.substitute(
+        subline=" ".join([escape(field) for field in subfields if field is not None]),
+        no=post.no,
+        file=file,
+        # Comments are already html
+        com=(COMMENT_TEMPLATE.substitute(com=post.com) if post.com else "")
+    )
+
+
+def writeLog(thread, posts, append=False):
+    """Stream posts into a thread's html log through a buffered writer.
+
+    Args:
+        thread (Thread): Thread the posts are from
+        posts (Iterable): Posts to write, in order
+        append (bool, optional): Add to the existing log instead of starting a new one
+    """
+    (logdir, filePath) = getMessageLogPath(thread.board, thread.semantic_url, thread.no)
+    os.makedirs(logdir, exist_ok=True)
+    with open(filePath + ".htm", "a" if append else "w", encoding="utf-8", buffering=RENDER_BUFFER) as textfile:
+        if not append:
+            textfile.write(HEADER)
+        for post in posts:
+            textfile.write(renderPost(thread, post, logdir))
+
+
+_archives = {}
+
+
+def renderArchivedThread(job):
+    """Worker: rewrite one thread's html log from the thread archive.
+
+    Args:
+        job (Tuple): (archive path, board, thread number, backend field mappings)
+
+    Returns:
+        Tuple: (board, thread number, last post number), or None on error
+    """
+    (dbpath, board, threadno, fields) = job
+    try:
+        # One connection per worker process
+        threadArchive = _archives.get(dbpath)
+        if threadArchive is None:
+            threadArchive = _archives[dbpath] = ThreadArchive(dbpath)
+        thread = Thread.fromJson(board, threadArchive.loadThread(board, threadno).get("posts"), fields)
+        writeLog(thread, thread.posts)
+        return (board, thread.no, thread.posts[-1].no)
+    except (OSError, sqlite3.Error, ValueError, AttributeError, IndexError, TypeError):
+        logger.error("Error rendering /{}/{}".format(board, threadno), exc_info=True)
+        return None
+
+
+def renderAll(jobs, workers=None):
+    """Rewrite many html logs from the thread archive, in a process pool.
+
+    Args:
+        jobs (List): Tuples of (archive path, board, thread number, backend field mappings)
+        workers (int, optional): Number of processes; one per cpu by default
+
+    Yields:
+        Tuple: (board, thread number, last post number), or None if the thread failed
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(renderArchivedThread, jobs, chunksize=64)
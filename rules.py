@@ -0,0 +1,134 @@
+import re
+
+from snip import jfileutil as ju
+from archive import postText
+
+from snip.stream import TriadLogger
+logger = TriadLogger(__name__)
+
+# Each rule selects threads matching all of its conditions; a thread is queued if
+# any rule for its board selects it. Patterns are case-insensitive regular
+# expressions, searched in the plain text of the OP's field.
+EXAMPLE_RULES = [
+    {
+        "boards": ["wsg"],
+        "sub": "ygyl|your (game|grill) you lose",
+        "minImages": 20
+    },
+    {
+        "boards": ["gd"],
+        "semantic_url": "logo",
+        "tags": ["Logo"],
+        "minReplies": 10
+    }
+]
+
+PATTERN_FIELDS = ("sub", "com", "semantic_url")
+
+
+class Rule():
+    """One compiled selection rule."""
+    __slots__ = ("boards", "patterns", "tags", "minReplies", "minImages")
+
+    def __init__(self, obj):
+        """
+        Args:
+            obj (Dict): Rule json object, as in the Rules file
+
+        Raises:
+            re.error: A pattern doesn't compile
+        """
+        self.boards = set(obj.get("boards") or []) or None
+        self.patterns = tuple(
+            (name, re.compile(obj.get(name), re.IGNORECASE))
+            for name in PATTERN_FIELDS
+            if obj.get(name)
+        )
+        self.tags = set(tag.lower() for tag in obj.get("tags") or []) or None
+        self.minReplies = obj.get("minReplies") or 0
+        self.minImages = obj.get("minImages") or 0
+
+    def appliesTo(self, board):
+        return self.boards is None or board in self.boards
+
+    def match(self, thread):
+        """
+        Args:
+            thread (Thread): Catalog thread
+
+        Returns:
+            bool: Whether the thread meets every condition of the rule
+        """
+        if (thread.replies or 0) < self.minReplies or (thread.images or 0) < self.minImages:
+            return False
+        if self.tags is not None and (thread.tag or "").lower() not in self.tags:
+            return False
+        for (name, pattern) in self.patterns:
+            value = thread.semantic_url if name == "semantic_url" else postText(getattr(thread, name))
+            if not value or not pattern.search(value):
+                return False
+        return True
+
+
+class RuleSet():
+    """All selection rules, compiled once and grouped by board."""
+
+    def __init__(self, rules):
+        """
+        Args:
+            rules (List): Rule json objects
+        """
+        self.rules = []
+        for obj in rules:
+            try:
+                self.rules.append(Rule(obj))
+            except re.error:
+                logger.error("Skipping rule with a bad pattern: {}".format(obj), exc_info=True)
+        self.boardRules = {}
+
+    def forBoard(self, board):
+        """
+        Args:
+            board (str): Board acronym
+
+        Returns:
+            Tuple: Rules that apply to the board
+        """
+        rules = self.boardRules.get(board)
+        if rules is None:
+            rules = self.boardRules[board] = tuple(rule for rule in self.rules if rule.appliesTo(board))
+        return rules
+
+    def select(self, board, threads):
+        """Pick the threads any rule matches, in one pass over a catalog.
+
+        Args:
+            board (str): Board acronym
+            threads (Iterable): Catalog threads
+
+        Returns:
+            List: Matching threads, in catalog order
+        """
+        rules = self.forBoard(board)
+        if not rules:
+            return []
+        return [
+            thread for thread in threads
+            if any(rule.match(thread) for rule in rules)
+        ]
+
+
+def loadRules():
+    """Load thread selection rules from file, handling defaults if needed.
+
+    Returns:
+        RuleSet
+    """
+    filename = "Rules"
+    try:
+        return RuleSet(ju.json_load(filename))
+    except FileNotFoundError:
+        ju.json_save(EXAMPLE_RULES, filename)
+        logger.info("Missing the rules file. A sample has been generated.")
+        logger.info("Please edit the template file in the jobj folder!")
+        return RuleSet(EXAMPLE_RULES)